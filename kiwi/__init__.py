@@ -1 +1,2 @@
-
+# The in-memory API (see "Using Kiwi from Python" in README.md)
+from kiwi import render, render_pages, KiwiTemplate
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Kiwi Benchmark
+
+Generates a synthetic site and times how long Kiwi takes to build it.
+
+Usage:
+    benchmark [--pages N] [--seed SEED] [--repeat R] [--mix MIX] [--org RATIO] [--output FILE] [--keep DIR]
+    benchmark --help
+
+Options:
+    -h --help
+    -n N --pages=N              [default: 200]
+    -s SEED --seed=SEED         [default: 1]
+    -r R --repeat=R             [default: 3]
+    -x MIX --mix=MIX            [default: paragraph=6,list=2,nested=1,table=1,code=1,block=1,header=2,tags=2]
+    -g RATIO --org=RATIO        [default: 0.1]
+    -o FILE --output=FILE
+    -k DIR --keep=DIR
+
+The site is generated from the given seed, so the same options always produce
+exactly the same files. It contains N pages, each built from a random
+selection of constructs, weighted according to the MIX option, which is a
+comma-separated list of construct=weight pairs. The available constructs are:
+
+    paragraph - plain text with occasional inline markup
+    list      - a simple list
+    nested    - a list with nested sub-lists
+    table     - a table with a header row
+    code      - a code: ... :code block
+    block     - an indented pre-formatted block
+    header    - '#' and underlined headers
+    tags      - user-defined @@ meta-data tags and @@DATE tags
+
+Every page declares and uses a @@PAGE-NAV element. The ORG option gives the
+fraction of the pages which are generated as org-mode files.
+
+Kiwi.execute() is timed end to end R times (with the contents page, using a
+template), and then the main stages (KiwiMarkup.execute, postprocess_file
+and write_page) are timed separately for every page. The start-up time is
+measured by running the kiwi script R times on a single page, in a new
+process each time, along with the time taken to start the interpreter on
+its own. The results are written as JSON to FILE, or to stdout if no FILE
+is given.
+
+The site is generated in a temporary directory which is deleted afterwards,
+unless the --keep option is used, in which case it is generated in DIR and
+left in place.
+"""
+
+# Standard library imports
+import sys
+import os
+import json
+import random
+import shutil
+import tempfile
+import platform
+import timeit
+import subprocess
+
+# Third party imports
+from docopt import docopt
+
+# Application specific imports
+import kiwi
+import kiwimark
+
+BENCHMARK_TEMPLATE = """<!doctype html>
+<html>
+  <head>
+    <title>@@TITLE</title>
+    <link rel="stylesheet" href="@@CSS">
+  </head>
+  <body>
+    <header><h1>@@TITLE</h1><p>@@AUTHOR, @@DATE</p></header>
+@@PAGE-NAV
+    <article>
+@@CONTENTS
+    </article>
+    <footer>@@COPYRIGHT @@DATE:"%Y"</footer>
+  </body>
+</html>
+"""
+
+# The constructs which can be included in the MIX option. Each of these is
+# the name of a KiwiCorpus method which returns the lines for the construct.
+CONSTRUCTS = ("paragraph", "list", "nested", "table", "code", "block", "header", "tags")
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua enim ad "
+         "minim veniam quis nostrud exercitation ullamco laboris nisi aliquip "
+         "ex ea commodo consequat duis aute irure in reprehenderit voluptate").split()
+
+class KiwiCorpus():
+    """
+    Generates a deterministic synthetic site. The same seed and options
+    always produce the same files.
+    """
+    def __init__(self, seed, mix, org_ratio):
+        self.random = random.Random(seed)
+        self.mix = mix
+        self.org_ratio = org_ratio
+        self.constructs = []
+        for name, weight in sorted(mix.items()):
+            self.constructs.extend([name] * weight)
+
+    def words(self, count):
+        return " ".join(self.random.choice(WORDS) for i in range(count))
+
+    def sentence(self):
+        """
+        Returns a line of text, with occasional inline markup.
+        """
+        words = self.words(self.random.randint(6, 16)).split()
+        markup = self.random.random()
+        pos = self.random.randint(0, len(words) - 1)
+        if markup < 0.1:
+            words[pos] = "**%s**" % words[pos]
+        elif markup < 0.2:
+            words[pos] = "_%s_" % words[pos]
+        elif markup < 0.25:
+            words[pos] = "[%s](http://example.com/%s)" % (words[pos], words[pos])
+        elif markup < 0.28:
+            words[pos] = "[[http://example.com/%s][%s]]" % (words[pos], words[pos])
+        return " ".join(words).capitalize() + "."
+
+    def paragraph(self):
+        return [self.sentence() for i in range(self.random.randint(1, 6))]
+
+    def list(self):
+        return ["* %s" % self.sentence() for i in range(self.random.randint(2, 8))]
+
+    def nested(self):
+        lines = []
+        for i in range(self.random.randint(2, 5)):
+            lines.append("* %s" % self.sentence())
+            for j in range(self.random.randint(0, 3)):
+                lines.append("    * %s" % self.sentence())
+        return lines
+
+    def table(self):
+        columns = self.random.randint(2, 6)
+        lines = ["| " + " | ".join(self.words(1) for i in range(columns)) + " |"]
+        lines.append("|" + "|".join("-----" for i in range(columns)) + "|")
+        for i in range(self.random.randint(2, 12)):
+            lines.append("| " + " | ".join(self.words(self.random.randint(1, 3)) for j in range(columns)) + " |")
+        return lines
+
+    def code(self):
+        lines = ["code:python"]
+        for i in range(self.random.randint(2, 10)):
+            lines.append("    %s = %s(%d) < %d" % (self.words(1), self.words(1), i, i * 2))
+        lines.append(":code")
+        return lines
+
+    def block(self):
+        return ["    %s & <%s>" % (self.words(4), self.words(1)) for i in range(self.random.randint(2, 6))]
+
+    def header(self):
+        if self.random.random() < 0.5:
+            return ["%s %s" % ("#" * self.random.randint(1, 4), self.words(3).title())]
+        text = self.words(3).title()
+        return [text, ("=" if self.random.random() < 0.5 else "-") * (len(text) + 6)]
+
+    def tags(self):
+        return ["Written by @@AUTHOR on @@DATE for @@TITLE, see @@CSS.",
+                '@@TAG%d:"%s"' % (self.random.randint(1, 40), self.words(2)),
+                "Tagged @@TAG%d and @@TAG%d." % (self.random.randint(1, 40), self.random.randint(1, 40))]
+
+    def page(self, number):
+        """
+        Returns the lines for a single page.
+        """
+        lines = ["Page %d: %s" % (number, self.words(3).title()), ""]
+        lines.append('@@AUTHOR:"%s"' % self.words(2).title())
+        lines.append('@@CSS:"style-%d.css"' % (number % 5))
+        lines.append('@@COPYRIGHT:"Copyright %s"' % self.words(1))
+        lines.append("@@PAGE-NAV")
+        lines.append("")
+        for i in range(self.random.randint(4, 24)):
+            construct = self.random.choice(self.constructs)
+            lines.extend(getattr(self, construct)())
+            lines.append("")
+        return lines
+
+    def org_page(self, number):
+        """
+        Returns the lines for a single org-mode page.
+        """
+        lines = ["-*- mode: org -*-", "Page %d: %s" % (number, self.words(3).title()), ""]
+        for i in range(self.random.randint(4, 24)):
+            level = self.random.randint(1, 3)
+            lines.append("%s %s" % ("*" * level, self.words(4).title()))
+            lines.extend(self.paragraph())
+            lines.append("")
+        return lines
+
+    def generate(self, path, pages):
+        """
+        Writes the pages to the given directory, returning the total number
+        of bytes written.
+        """
+        total = 0
+        for number in range(1, pages + 1):
+            if self.random.random() < self.org_ratio:
+                lines = self.org_page(number)
+            else:
+                lines = self.page(number)
+            text = "\n".join(lines) + "\n"
+            f = open(os.path.join(path, "page%05d.txt" % number), "w")
+            f.write(text)
+            f.close()
+            total += len(text)
+        return total
+
+def parse_mix(mix):
+    """
+    Converts a MIX option ('name=weight,name=weight') into a dictionary.
+    """
+    weights = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        name = name.strip()
+        if name not in CONSTRUCTS:
+            raise ValueError("Unknown construct: %s" % name)
+        weights[name] = int(weight)
+    return weights
+
+def summary(times):
+    """
+    Returns the minimum, mean and total of a list of timings.
+    """
+    return {
+        "count": len(times),
+        "total": sum(times),
+        "min": min(times) if times else 0.0,
+        "mean": sum(times) / len(times) if times else 0.0
+    }
+
+def time_execute(source_path, target_path, template_file, repeat):
+    """
+    Times complete runs of Kiwi.execute(), returning a list of timings.
+    """
+    times = []
+    for i in range(repeat):
+        if os.path.exists(target_path):
+            shutil.rmtree(target_path)
+        params = docopt(kiwi.__doc__, argv = [source_path, "--target", target_path, "--template", template_file, "--sortbyfile", "-c"])
+        api = kiwi.Kiwi()
+        start = timeit.default_timer()
+        api.execute(params)
+        times.append(timeit.default_timer() - start)
+    return times
+
+def time_command(arguments, repeat):
+    """
+    Times complete runs of a command, returning a list of timings.
+    """
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        subprocess.check_call(arguments)
+        times.append(timeit.default_timer() - start)
+    return times
+
+def time_stages(source_path, target_path, template_file):
+    """
+    Times the main stages separately for each page, returning a dictionary
+    of lists of timings, keyed by stage name. The pages are written to an
+    empty target directory, as unchanged files are not written again, so
+    writing over the files from Kiwi.execute() would only time a compare.
+    """
+    params = docopt(kiwi.__doc__, argv = [source_path, "--target", target_path, "--template", template_file, "--sortbyfile"])
+    api = kiwi.Kiwi()
+    api.execute(params)
+    shutil.rmtree(target_path)
+    os.makedirs(target_path)
+
+    times = {"markup": [], "postprocess": [], "write": []}
+    marker = kiwimark.KiwiMarkup()
+    for page in api.pages.files:
+        api.load_file(page)
+
+        start = timeit.default_timer()
+        marker.execute(api.input)
+        times["markup"].append(timeit.default_timer() - start)
+
+        api.input = marker.output
+        api.apply_template()
+
+        start = timeit.default_timer()
+        api.postprocess_file(page.source_file)
+        times["postprocess"].append(timeit.default_timer() - start)
+
+        start = timeit.default_timer()
+        api.write_page(page.source_file)
+        times["write"].append(timeit.default_timer() - start)
+    return times
+
+def run(params):
+    """
+    Generates the site and runs the benchmarks, returning the results as
+    a dictionary.
+    """
+    pages = int(params["--pages"])
+    seed = int(params["--seed"])
+    repeat = int(params["--repeat"])
+    mix = parse_mix(params["--mix"])
+    org_ratio = float(params["--org"])
+
+    if params["--keep"]:
+        base_path = os.path.abspath(params["--keep"])
+        if not os.path.exists(base_path):
+            os.makedirs(base_path)
+    else:
+        base_path = tempfile.mkdtemp(prefix = "kiwi-benchmark-")
+    try:
+        source_path = os.path.join(base_path, "site")
+        target_path = os.path.join(base_path, "html")
+        template_file = os.path.join(base_path, "template.html")
+        if not os.path.exists(source_path):
+            os.makedirs(source_path)
+        f = open(template_file, "w")
+        f.write(BENCHMARK_TEMPLATE)
+        f.close()
+
+        corpus_bytes = KiwiCorpus(seed, mix, org_ratio).generate(source_path, pages)
+
+        execute_times = time_execute(source_path, target_path, template_file, repeat)
+        stage_times = time_stages(source_path, target_path, template_file)
+
+        kiwi_script = os.path.splitext(kiwi.__file__)[0] + ".py"
+        single_file = os.path.join(source_path, "page00001.txt")
+        startup_times = time_command([sys.executable, kiwi_script, single_file, "--target", os.path.join(base_path, "single")], repeat)
+        interpreter_times = time_command([sys.executable, "-c", "pass"], repeat)
+    finally:
+        if not params["--keep"]:
+            shutil.rmtree(base_path)
+
+    results = {
+        "corpus": {
+            "pages": pages,
+            "bytes": corpus_bytes,
+            "seed": seed,
+            "mix": mix,
+            "org": org_ratio
+        },
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "execute": summary(execute_times),
+        "stages": dict((name, summary(times)) for name, times in stage_times.items()),
+        "startup": summary(startup_times),
+        "interpreter": summary(interpreter_times)
+    }
+    return results
+
+if (__name__ == "__main__"):
+    params = docopt(__doc__)
+    results = run(params)
+    output = json.dumps(results, indent=4, separators=(',', ':'), sort_keys=True)
+    if params["--output"]:
+        f = open(params["--output"], "w")
+        f.write(output + "\n")
+        f.close()
+    else:
+        print output
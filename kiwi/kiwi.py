@@ -5,7 +5,8 @@
 Simple static web-site generator
 
 Usage:
-    kiwi [SOURCE] [--target TARGET] [--template TEMPLATE] [--sortbyfile|--sortbytitle] [--savefile CONFIG] [-vc]
+    kiwi serve [SOURCE] [--template TEMPLATE] [--sortbyfile|--sortbytitle] [--include PATTERNS] [--exclude PATTERNS] [--port PORT] [--cache N] [--highlight] [-vr]
+    kiwi [SOURCE] [--target TARGET] [--template TEMPLATE] [--sortbyfile|--sortbytitle] [--include PATTERNS] [--exclude PATTERNS] [--savefile CONFIG] [--jobs N | --pipeline] [--cachedir DIR [--cachesize MB]] [--minify] [--highlight] [--profile [--slowest N] [--pstats FILE]] [-vciwrz]
     kiwi --version
                     
 Options:                      
@@ -15,9 +16,26 @@ Options:
     -m TEMPLATE --template=TEMPLATE
     -v --verbose                
     -c --contents               
+    -i --incremental
     --sortbyfile                
     --sortbytitle               
     -f CONFIG --savefile=CONFIG
+    -j N --jobs=N
+    --pipeline
+    --minify
+    --highlight
+    -w --watch
+    -r --recursive
+    -z --compress
+    --include=PATTERNS
+    --exclude=PATTERNS
+    -p --profile
+    --port=PORT
+    --cache=N
+    --cachedir=DIR
+    --cachesize=MB
+    --slowest=N
+    --pstats=FILE
 
 Kiwi takes a directory of text files and exports them to another directory as
 web-pages, using KiwiMarkup to convert the text markup into HTML elements.
@@ -35,6 +53,16 @@ processed.  If it is not a directory, it is assumed to be a complete file spec
 If SOURCE is not specified, any .txt files in the current working directory
 are processed.
 
+If the -r (recursive) option is specified and SOURCE is a directory, the
+files in all its sub-directories are processed as well (apart from hidden
+directories and the target directory), and the HTML files are written to
+the same sub-directories of the target directory. The --include option
+replaces the default list of file patterns ("*.txt,*.md") with another
+comma-separated list, and the --exclude option gives a comma-separated list
+of patterns for files or directories to skip. The exclude patterns are
+matched against both the name and the path relative to SOURCE, so that for
+example "drafts" or "drafts/*" will skip a drafts directory.
+
 If TARGET is a directory, the HTML files are output to this directory.
 
 If TARGET is not specified, and SOURCE is a directory, an 'html' directory
@@ -58,6 +86,76 @@ processed.
 If the -c (contents) option is specified, Kiwi will create an index.html
 file with a 'contents' list of links to all the other files.
 
+If the -z (compress) option is specified, a gzip-compressed copy of each
+page is written alongside it (as page.html.gz), along with a brotli-compressed
+copy (page.html.br) if the brotli module is installed, for web-servers which
+can serve pre-compressed files. The copies are only written again when the
+page itself changes.
+
+If the --minify option is specified, the pages are made smaller by removing
+HTML comments and the indentation and line breaks between HTML tags (line
+breaks are only removed next to block-level tags such as <p> and <td>,
+where they make no difference to the page). The contents of <pre>,
+<code>, <textarea>, <script> and <style> elements are left exactly as they
+are.
+
+If the --highlight option is specified, code blocks which name their language
+(code:python, for example) are syntax-highlighted, using Pygments if it is
+installed, or otherwise a simple built-in highlighter which knows Python,
+JavaScript, C-like languages, shell scripts and SQL. The parts of the code
+are marked with <span> tags using the same class names as Pygments, so any
+Pygments style sheet can be used to colour them.
+
+If the -i (incremental) option is specified, Kiwi keeps a manifest of the
+pages it has built in the target directory, and on subsequent runs only
+rebuilds the pages whose source, template, navigation links or meta-data
+values have changed since the last run.
+
+If the -j (jobs) option is specified, the pages are converted by a pool of N
+worker processes instead of one after another. A value of 0 uses one process
+for each CPU. The output is identical to that of a normal build.
+
+If the --pipeline option is specified (instead of -j), the source files are
+read ahead by a background thread, and the finished pages are written by a
+pool of background threads, so that reading and writing the files overlaps
+with converting the pages. This helps most when the files are on a slow or
+network file system. Only a limited number of pages are held in memory
+waiting to be converted or written at any one time.
+
+If the -w (watch) option is specified, Kiwi does not exit after building the
+pages, but keeps watching the source files, the template and the .kiwi file
+(if any) for changes. When a source file changes, only that page is rebuilt,
+along with any pages whose page-navigation links are affected, and the
+index.html page if the -c option is used and the list of pages or their
+titles have changed. If the template changes all the pages are rebuilt, and
+if the .kiwi file changes the whole build is repeated using its new details.
+Press Ctrl+C to stop watching.
+
+If the --cachedir option is specified, the HTML produced from the markup of
+each page is kept in DIR, keyed by the contents of the source file (and the
+version of KiwiMarkup), and is used again by any later build of a page with
+the same contents, instead of converting the markup again. The template and
+the meta-data tags are still applied afresh, so changes to them do not
+affect the cache. The directory can be shared between builds of different
+sites. When it grows beyond MB megabytes (256 by default) the entries which
+have gone unused for longest are removed. With the -v option the number of
+cache hits and misses are reported.
+
+If the -p (profile) option is specified, Kiwi records the time taken by each
+stage of the build (scanning the source files for their titles, loading,
+converting the markup, applying the template, post-processing and writing
+the pages) and by each page, and prints a summary at the end, including the
+N slowest pages (10 by default, or as given by --slowest). If --pstats is
+also given, a cProfile of the whole build is saved to FILE, for use with the
+pstats module.
+
+The 'serve' command starts a web-server for previewing the pages, at
+http://localhost:8000/ (or at the given PORT). Nothing is written to disk.
+Instead, each page is converted the first time it is requested, and is then
+kept in memory (for up to N pages, 256 by default) until its source file
+changes. The index page is always available, and any other files in the
+source directory (such as style-sheets and images) are served as they are.
+
 If the --sortbyfile argument is used, the pages are sorted into order by
 filename.
 
@@ -113,19 +211,137 @@ replaced correctly.
 
 """
 
-# Standard library imports
+# Standard library imports. Modules which are only needed by some of the
+# options (json, multiprocessing, cProfile, gzip, threading, Queue and
+# collections) are imported where they are used, as is docopt, so that
+# converting a single file starts quickly.
+import sys
 import os
 import glob
 import re
 import datetime
-import json
-
-# Third party imports
-from docopt import docopt
+import hashlib
+import cStringIO
+import timeit
+import time
+import stat
+import fnmatch
+import posixpath
 
 # Application specific imports
 import kiwimark
 
+# Maximum number of bytes of source files to keep in memory after reading
+# their titles, so that they do not have to be read again when they are
+# converted. Files beyond this limit are simply read a second time.
+PAGE_CACHE_LIMIT = 64 * 1024 * 1024
+
+# Regex to split a meta-data tag into three parts: the tag name, the
+# optional declaration, and the double-quoted replacement text (or date
+# format) within the declaration.
+TAG_PATTERN = re.compile('(@@[a-zA-Z0-9_-]+)(:("[^"]*"))?', re.IGNORECASE)
+
+# Tags which are replaced by values that Kiwi supplies itself
+SYSTEM_TAGS = ["@@PAGE-NAV", "@@DATE"]
+
+# Maximum number of compiled tag patterns to keep (see Kiwi.tag_pattern)
+TAG_PATTERN_CACHE_SIZE = 256
+
+# Default patterns for the source files in a source directory
+SOURCE_PATTERNS = "*.txt,*.md"
+
+# Flags for creating the temporary files which replace the output files
+# (see temp_filename). They are created with mode 0666, less the umask, as
+# with open(), so the output files get the usual permissions.
+TEMP_FILE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+# Number of seconds between checks for changed files in watch mode
+WATCH_INTERVAL = 0.5
+
+# Elements whose contents are left exactly as they are by KiwiMinifier
+MINIFY_RAW_TAGS = ("pre", "code", "textarea", "script", "style")
+
+# Block-level elements, next to which whitespace makes no difference to the
+# page, so that KiwiMinifier can remove it completely
+MINIFY_BLOCK_TAGS = frozenset("""html head body title meta link base div p ul
+    ol li dl dt dd table thead tbody tfoot tr th td caption pre blockquote h1
+    h2 h3 h4 h5 h6 hr br header footer article section nav aside main figure
+    figcaption form fieldset address""".split())
+
+# Patterns used by KiwiMinifier: the start of a comment or of an element
+# whose contents are left alone, the whitespace between two tags, and the
+# tags at the start and end of a line
+MINIFY_PATTERN = re.compile(r"<!--|<(/?)(%s)\b[^>]*>" % "|".join(MINIFY_RAW_TAGS), re.IGNORECASE)
+TAG_GAP_PATTERN = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)[^<>]*>(\s+)(?=</?([a-zA-Z][a-zA-Z0-9]*))")
+FIRST_TAG_PATTERN = re.compile(r"^</?([a-zA-Z][a-zA-Z0-9]*)")
+LAST_TAG_PATTERN = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)[^<>]*>$")
+
+# Compression level for the gzip-compressed copies of the pages
+GZIP_LEVEL = 9
+
+# Number of pages which can be waiting to be converted, and waiting to be
+# written, and the number of threads which write the pages, for pipelined
+# builds (see Kiwi.process_pages_in_pipeline)
+PIPELINE_DEPTH = 32
+PIPELINE_WRITERS = 4
+
+# Number of threads which write the compressed copies of the pages (see
+# KiwiCompressor)
+COMPRESS_THREADS = 4
+
+# Default port and number of cached pages for the preview web-server
+SERVE_PORT = 8000
+SERVE_CACHE_SIZE = 256
+
+# Maximum number of seconds between full scans of the source files by the
+# preview web-server, when no directories appear to have changed (see
+# Kiwi.refresh_pages)
+SERVE_RESCAN_INTERVAL = 5
+
+# Default maximum size of the markup cache directory, in megabytes
+MARKUP_CACHE_SIZE = 256
+
+# Name of the file, in the target directory, which holds the build manifest
+# used for incremental builds.
+MANIFEST_FILE = ".kiwi-manifest"
+
+# Optional modules which have been imported (see optional_module)
+OPTIONAL_MODULES = {}
+
+VERSION = "Kiwi, version 0.0.33"
+
+# The parameters which docopt returns when no arguments are given. This
+# must include every option in the usage text, as parse_arguments() starts
+# from a copy of it when it parses the arguments itself.
+DEFAULT_PARAMS = {
+    "SOURCE": None, "serve": False,
+    "--target": None, "--template": None, "--include": None, "--exclude": None,
+    "--savefile": None, "--jobs": None, "--pipeline": False, "--cachedir": None,
+    "--cachesize": None, "--cache": None, "--port": None, "--sortbyfile": False,
+    "--sortbytitle": False, "--minify": False, "--highlight": False,
+    "--profile": False, "--slowest": None, "--pstats": None, "--verbose": False,
+    "--contents": False, "--incremental": False, "--watch": False,
+    "--recursive": False, "--compress": False, "--version": False
+}
+
+# Options which parse_arguments() handles without docopt, with the key for
+# each one and whether it takes a value
+FAST_OPTIONS = {
+    "-t": ("--target", True), "--target": ("--target", True),
+    "-m": ("--template", True), "--template": ("--template", True),
+    "--include": ("--include", True), "--exclude": ("--exclude", True),
+    "-j": ("--jobs", True), "--jobs": ("--jobs", True),
+    "--cachedir": ("--cachedir", True), "--pipeline": ("--pipeline", False),
+    "--sortbyfile": ("--sortbyfile", False), "--sortbytitle": ("--sortbytitle", False),
+    "--minify": ("--minify", False), "--highlight": ("--highlight", False),
+    "-v": ("--verbose", False), "--verbose": ("--verbose", False),
+    "-c": ("--contents", False), "--contents": ("--contents", False),
+    "-i": ("--incremental", False), "--incremental": ("--incremental", False),
+    "-w": ("--watch", False), "--watch": ("--watch", False),
+    "-r": ("--recursive", False), "--recursive": ("--recursive", False),
+    "-z": ("--compress", False), "--compress": ("--compress", False)
+}
+
 DEFAULT_PAGE_TEMPLATE = """
 <!doctype html>
 <html lang="en">
@@ -160,23 +376,66 @@ DEFAULT_PAGE_TEMPLATE = """
 </html>
 """
 
-class KiwiPage():
+class KiwiPage(object):
     """
-    Class to hold details of individual pages, including their source
-    and target filenames, and links for page navigation.
+    Class to hold details of individual pages: the source filename and the
+    title. If the contents of the source file were kept when the page was
+    added to the list, they are held (as a list of lines) in the lines
+    attribute.
+
+    As a site can have a very large number of pages, the details are held in
+    slots instead of a dictionary for each page, and the source filename is
+    held as its directory (which is shared by all the pages in the same
+    directory, see KiwiPageList.new_page) and the name of the file. The link
+    to the page is not held at all, as it can be worked out from the source
+    filename (see KiwiPageList.link).
     """
-    source_file = ""
-    target_file = ""
-    link = ""
-    title = ""
+    __slots__ = ("directory", "name", "title", "lines")
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self.title = ""
+        self.lines = None
+
+    @property
+    def source_file(self):
+        return os.path.join(self.directory, self.name)
+
+    # Slots are not pickled by default (the pages are passed to the worker
+    # processes for parallel builds). The contents are left out, as the
+    # workers read the source files themselves.
+    def __getstate__(self):
+        return (self.directory, self.name, self.title)
+
+    def __setstate__(self, state):
+        self.directory, self.name, self.title = state
+        self.lines = None
 
 class KiwiPageList():
     """
     Class to hold the list of KiwiPage instances used for building the
     final output files.
+
+    To avoid reading each source file twice (once for its title, and again
+    when it is converted), the contents of the files are kept when they are
+    added, up to a total of cache_limit bytes. Any files beyond this limit
+    are read again when they are needed.
     """
-    files = []
-    target_path = ""
+    def __init__(self):
+        self.files = []
+        self.target_path = ""
+        self.source_root = ""
+        self.cache_limit = PAGE_CACHE_LIMIT
+        self.cache_size = 0
+        # Position of each page in the list, keyed by directory and then by
+        # file name, used to find the adjacent pages for page-navigation.
+        # This is only built when it is first needed (see position), as
+        # most sites do not use page-navigation.
+        self.positions = None
+        # The directories of the pages, so that each directory name is only
+        # held once (see new_page)
+        self.directories = {}
 
     def add(self, source_file):
         """
@@ -190,42 +449,194 @@ class KiwiPageList():
         The target_path attribute of this class must be set before
         calling this function.
         """
-        page = KiwiPage()
-        page.source_file = source_file
-        page.target_file = self.target_filename(source_file)
+        page = self.read_page(source_file)
+        self.files.append(page)
+        if self.positions is not None:
+            self.set_position(page, len(self.files) - 1)
+
+    def read_page(self, source_file):
+        """
+        Returns a new KiwiPage instance for the specified file, with its
+        title, keeping the contents of the file if there is room for them.
+        """
+        page = self.new_page(source_file)
 
         f = open(source_file)
-        title = ""
-        for line in f:
+        size = os.fstat(f.fileno()).st_size
+        if self.cache_size + size <= self.cache_limit:
+            # Keep the contents, so that the file does not have to be
+            # read again when it is converted
+            contents = f.read()
+            page.lines = cStringIO.StringIO(contents).readlines()
+            self.cache_size += len(contents)
+            lines = page.lines
+        else:
+            # Only read as far as the title
+            lines = f
+        self.read_title(page, lines)
+        f.close()
+        return page
+
+    def add_text(self, name, text):
+        """
+        Adds a page whose contents are given as text instead of being read
+        from a file. The name takes the place of the source filename.
+        """
+        page = self.new_page(name)
+        page.lines = cStringIO.StringIO(text).readlines()
+        self.cache_size += len(text)
+        self.read_title(page, page.lines)
+        self.files.append(page)
+        if self.positions is not None:
+            self.set_position(page, len(self.files) - 1)
+
+    def new_page(self, source_file):
+        """
+        Returns a new KiwiPage instance for the specified file, sharing the
+        directory name with any other pages in the same directory.
+        """
+        directory, name = os.path.split(source_file)
+        directory = self.directories.setdefault(directory, directory)
+        return KiwiPage(directory, name)
+
+    def read_title(self, page, lines):
+        """
+        Sets the title of the page from the first non-blank line.
+        """
+        for line in lines:
             if line.strip() is not "":
                 page.title = line.strip()
-                page.link  = os.path.basename(page.target_file)
                 break
+
+    def link(self, page):
+        """
+        Returns the link to the HTML file for the page, relative to the
+        target path. Pages with no title are left without a link.
+        """
+        if not page.title:
+            return ""
+        return self.relative_target(page.source_file).replace(os.sep, "/")
+
+    def refresh(self, source_file):
+        """
+        Reads the specified file again, after it has changed, replacing its
+        existing entry in the list, or adding it if it is not yet in the
+        list.
+        """
+        pos = self.position(source_file)
+        if pos is None:
+            self.add(source_file)
+        else:
+            self.release(self.files[pos])
+            self.files[pos] = self.read_page(source_file)
+
+    def remove(self, source_file):
+        """
+        Removes the specified file from the list.
+        """
+        pos = self.position(source_file)
+        if pos is not None:
+            self.release(self.files[pos])
+            del self.files[pos]
+            self.index_files()
+
+    def release(self, page):
+        """
+        Discards any contents kept for the page.
+        """
+        if page.lines is not None:
+            self.cache_size -= sum(len(line) for line in page.lines)
+            page.lines = None
+
+    def read_lines(self, page):
+        """
+        Returns the contents of the source file for the page, as a list
+        of lines. If the contents were kept when the page was added they
+        are released, as each page is only converted once.
+        """
+        if page.lines is not None:
+            lines = page.lines
+            self.release(page)
+            return lines
+        f = open(page.source_file)
+        lines = f.readlines()
         f.close()
-        
-        self.files.append(page)
+        return lines
     
-    def target_filename(self, source_file):
+    def relative_target(self, source_file):
+        """
+        Returns the path of the HTML file for the given source file, relative
+        to the target path. Files in sub-directories of the source_root are
+        written to the same sub-directories of the target path.
+        """
+        directory = ""
+        if self.source_root and source_file.startswith(self.source_root + os.sep):
+            directory = os.path.dirname(source_file[len(self.source_root) + 1:])
+        elif not self.source_root and not os.path.isabs(source_file):
+            # The name of a page given as text (see add_text)
+            directory = os.path.dirname(source_file)
+
         # Extract the filename from the complete source path
         path, filename = os.path.split(source_file)
         
         # Remove the extension from the filename
         filename, ext = os.path.splitext(filename)
 
+        return os.path.join(directory, filename + ".html")
+
+    def target_filename(self, source_file):
         # Construct the full target path
-        return os.path.join(self.target_path, filename + ".html")
+        return os.path.join(self.target_path, self.relative_target(source_file))
 
     def sort_by_title(self):
         """
         Sorts the pages by their title.
         """
         self.files = sorted(self.files, key = lambda entry: entry.title)
+        self.index_files()
 
     def sort_by_file(self):
         """
         Sorts the pages by their title.
         """
         self.files = sorted(self.files, key = lambda entry: entry.source_file)
+        self.index_files()
+
+    def index_files(self):
+        """
+        Discards the index of the position of each page in the list, so
+        that it is rebuilt when it is next needed. This must be called
+        whenever the list is re-ordered or replaced.
+        """
+        self.positions = None
+
+    def set_position(self, page, pos):
+        """
+        Records the position of the page in the list, unless there is
+        already a page for the same file.
+        """
+        names = self.positions.get(page.directory)
+        if names is None:
+            names = self.positions[page.directory] = {}
+        names.setdefault(page.name, pos)
+
+    def position(self, source_file):
+        """
+        Returns the position of the page for the specified file in the list,
+        or None if it is not in the list.
+        """
+        if self.positions is None:
+            self.positions = {}
+            for idx, entry in enumerate(self.files):
+                self.set_position(entry, idx)
+        directory, name = os.path.split(source_file)
+        names = self.positions.get(directory)
+        if names is None:
+            return None
+        return names.get(name)
+
+    def __contains__(self, source_file):
+        return self.position(source_file) is not None
 
     def adjacent_files(self, source_file):
         """
@@ -236,21 +647,784 @@ class KiwiPageList():
         """
         preceding = None
         following = None
-        files = [idx for idx, entry in enumerate(self.files) if entry.source_file == source_file]
-        if len(files) > 0:
-            pos = files[0]
+        pos = self.position(source_file)
+        if pos is not None:
             if pos > 0:
                 preceding = self.files[pos - 1]
             if pos + 1 < len(self.files):
                 following = self.files[pos + 1]
         return (preceding, following)
+
+def optional_module(name):
+    """
+    Returns the named module, or None if it is not installed. Optional
+    modules (pyinotify, scandir and brotli) are only imported when they are
+    first needed.
+    """
+    if name not in OPTIONAL_MODULES:
+        try:
+            OPTIONAL_MODULES[name] = __import__(name)
+        except ImportError:
+            OPTIONAL_MODULES[name] = None
+    return OPTIONAL_MODULES[name]
+
+def list_directory(directory):
+    """
+    Returns a list of (name, is_directory, entry) tuples for the contents of
+    the directory, where entry can be passed to entry_stat() to get the
+    details of the file. The scandir module is used if it is installed, as
+    it can usually tell directories from files without calling os.stat().
+
+    Symbolic links to directories are left out (os.walk() does not follow
+    them either), so that a link back up the tree cannot make a recursive
+    scan loop.
+    """
+    scandir = optional_module("scandir")
+    entries = []
+    if scandir is not None:
+        for entry in scandir.scandir(directory):
+            is_directory = entry.is_dir()
+            if is_directory and entry.is_symlink():
+                continue
+            entries.append((entry.name, is_directory, entry))
+        return entries
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        is_directory = stat.S_ISDIR(info.st_mode)
+        if is_directory and os.path.islink(path):
+            continue
+        entries.append((name, is_directory, (path, info)))
+    return entries
+
+def entry_stat(entry):
+    """
+    Returns the os.stat() details for an entry from list_directory().
+    """
+    if isinstance(entry, tuple):
+        return entry[1]
+    return entry.stat()
+
+def matches(name, patterns):
+    """
+    Returns True if the name matches any of the fnmatch patterns.
+    """
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+def scan_directory(path, include, exclude, recursive, skip = None):
+    """
+    Returns a dictionary of the os.stat() details of the files in the given
+    directory whose names match the include patterns, keyed by the full path
+    of the file. Files and directories matching the exclude patterns (by
+    name, or by path relative to the directory) are skipped, as are hidden
+    files and directories (as with glob) and the skip directory, if any. If
+    recursive is True the sub-directories are scanned as well.
+    """
+    found = {}
+    directories = [(path, "")]
+    while directories:
+        directory, relative = directories.pop()
+        for name, is_directory, entry in list_directory(directory):
+            if name.startswith("."):
+                continue
+            relative_name = relative + name
+            if matches(name, exclude) or matches(relative_name, exclude):
+                continue
+            full_name = os.path.join(directory, name)
+            if is_directory:
+                if recursive and full_name != skip:
+                    directories.append((full_name, relative_name + "/"))
+            elif matches(name, include):
+                found[full_name] = entry_stat(entry)
+    return found
+
+def temp_filename(directory):
+    """
+    Returns a new, unique name for a temporary file in the directory. The
+    file should be created with TEMP_FILE_FLAGS, which fails if the file
+    already exists.
+    """
+    return os.path.join(directory, ".kiwi-" + os.urandom(8).encode("hex"))
+
+class KiwiTemplate():
+    """
+    Class to hold an HTML template. The template is split once, when it is
+    loaded, into the sections of lines which surround each @@CONTENTS marker,
+    so that wrapping a page in the template only involves joining lists of
+    lines together.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.hash = hashlib.md5(text).hexdigest()
+        self.sections = [[]]
+        for line in text.split("\n"):
+            if line.strip().upper() == "@@CONTENTS":
+                self.sections.append([])
+            else:
+                self.sections[-1].append(line)
+
+    def apply(self, lines):
+        """
+        Returns a new list of lines, consisting of the template with the
+        given lines inserted in place of each @@CONTENTS marker.
+        """
+        output = list(self.sections[0])
+        for section in self.sections[1:]:
+            output.extend(lines)
+            output.extend(section)
+        return output
+
+# Templates which have already been loaded, keyed by filename. Each entry
+# holds the modification time of the file and the KiwiTemplate instance.
+template_cache = {}
+
+def load_template(template_file):
+    """
+    Returns the KiwiTemplate for the given file, only reading the file if
+    it has not already been loaded or if it has changed since it was loaded.
+    """
+    mtime = os.path.getmtime(template_file)
+    cached = template_cache.get(template_file)
+    if cached is None or cached[0] != mtime:
+        f = open(template_file)
+        cached = (mtime, KiwiTemplate(f.read()))
+        f.close()
+        template_cache[template_file] = cached
+    return cached[1]
+
+def default_template():
+    """
+    Returns the KiwiTemplate for the internal default template.
+    """
+    cached = template_cache.get(None)
+    if cached is None:
+        cached = (None, KiwiTemplate(DEFAULT_PAGE_TEMPLATE))
+        template_cache[None] = cached
+    return cached[1]
+
+class KiwiProfile():
+    """
+    Class to hold the timings for a build: the number of calls and the total
+    time for each stage of the build, and the total time for each page.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.pages = {}
+
+    def record(self, stage, seconds):
+        """
+        Adds a call of the given duration to the totals for the stage.
+        """
+        calls, total = self.stages.get(stage, (0, 0.0))
+        self.stages[stage] = (calls + 1, total + seconds)
+
+    def record_page(self, source_file, seconds):
+        """
+        Records the total time taken to process a page.
+        """
+        self.pages[source_file] = self.pages.get(source_file, 0.0) + seconds
+
+    def merge(self, other):
+        """
+        Adds the timings from another KiwiProfile instance (from a worker
+        process) to this one.
+        """
+        for stage, (calls, seconds) in other.stages.items():
+            total_calls, total_seconds = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (total_calls + calls, total_seconds + seconds)
+        for source_file, seconds in other.pages.items():
+            self.record_page(source_file, seconds)
+
+    def slowest(self, count):
+        """
+        Returns a list of (source_file, seconds) tuples for the slowest
+        pages, slowest first.
+        """
+        return sorted(self.pages.items(), key = lambda entry: -entry[1])[:count]
+
+    def results(self, count = 10):
+        """
+        Returns the timings as a dictionary, suitable for converting to JSON.
+        """
+        return {
+            "stages": dict((stage, {"calls": calls, "seconds": seconds}) for stage, (calls, seconds) in self.stages.items()),
+            "pages": len(self.pages),
+            "slowest": [{"source": source_file, "seconds": seconds} for source_file, seconds in self.slowest(count)]
+        }
+
+    def report(self, count = 10):
+        """
+        Prints a summary of the timings.
+        """
+        print "%-12s %8s %10s" % ("Stage", "Calls", "Seconds")
+        for stage, (calls, seconds) in sorted(self.stages.items(), key = lambda entry: -entry[1][1]):
+            print "%-12s %8d %10.4f" % (stage, calls, seconds)
+        print
+        print "Slowest pages:"
+        for source_file, seconds in self.slowest(count):
+            print "%10.4f  %s" % (seconds, source_file)
+
+class KiwiWatcher():
+    """
+    Class to detect changes to a set of files, by comparing their
+    modification times and sizes. If the pyinotify module is installed it
+    is used to wait for changes to the directories holding the files,
+    otherwise the files are simply checked at regular intervals.
+    """
+    def __init__(self, interval = WATCH_INTERVAL):
+        self.interval = interval
+        self.notifier = None
+        self.manager = None
+        self.directories = set()
+
+    def watch_directories(self, directories):
+        """
+        Sets the directories to be watched for changes, if pyinotify is
+        available.
+        """
+        pyinotify = optional_module("pyinotify")
+        if pyinotify is None:
+            return
+        if self.notifier is None:
+            self.manager = pyinotify.WatchManager()
+            # Events are only used to wake up wait(), so they are discarded
+            self.notifier = pyinotify.Notifier(self.manager, lambda event: None)
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_CLOSE_WRITE
+        for directory in set(directories) - self.directories:
+            self.manager.add_watch(directory, mask, rec = True, auto_add = True)
+            self.directories.add(directory)
+
+    def wait(self):
+        """
+        Waits until something might have changed. Returns True if the files
+        need to be checked again, which is always the case when polling, or
+        False if pyinotify reported no events during the interval.
+        """
+        if self.notifier is not None:
+            if self.notifier.check_events(int(self.interval * 1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+                return True
+            return False
+        time.sleep(self.interval)
+        return True
+
+    def snapshot(self, filenames, stats = None):
+        """
+        Returns a dictionary of the modification time and size of each of
+        the given files, keyed by filename. Files which do not exist are
+        omitted. The stats dictionary can supply os.stat() details which
+        are already known, to avoid reading them again.
+        """
+        files = {}
+        for filename in filenames:
+            info = stats.get(filename) if stats else None
+            if info is None:
+                try:
+                    info = os.stat(filename)
+                except OSError:
+                    continue
+            files[filename] = (info.st_mtime, info.st_size)
+        return files
+
+class KiwiRenderCache():
+    """
+    Class to hold converted pages in memory, for the preview web-server. Each
+    page is stored with a version (the modification time and size of its
+    source file), and is only returned if the version still matches. When
+    the cache is full, the least recently used page is discarded.
+    """
+    def __init__(self, size = SERVE_CACHE_SIZE):
+        import collections
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """
+        Returns the cached page, or None if it is not in the cache or is out
+        of date.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        # Move the entry to the end, as the most recently used
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, version, html):
+        """
+        Stores a page in the cache, discarding the least recently used
+        pages if the cache is full.
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = (version, html)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+
+class KiwiManifest():
+    """
+    Class to hold the build manifest used for incremental builds. For each
+    page this records the details that the final output depends on (the
+    hashes of the source and the template, the resolved meta-data values
+    and the page-navigation links), so that pages which have not changed
+    since the previous build can be skipped.
+    """
+    def __init__(self, target_path):
+        self.filename = os.path.join(target_path, MANIFEST_FILE)
+        self.entries = {}
+        self.previous = {}
+        if os.path.exists(self.filename):
+            import json
+            f = open(self.filename)
+            try:
+                self.previous = json.loads(f.read())
+            except ValueError:
+                # A damaged manifest simply forces a full rebuild
+                self.previous = {}
+            f.close()
+
+    def normalise(self, entry):
+        """
+        Returns the entry as it would be read back from the manifest file
+        (json.loads returns Unicode), so that it can be compared against
+        the previous entries.
+        """
+        import json
+        return json.loads(json.dumps(entry))
+
+    def is_current(self, target_file, entry):
+        """
+        Returns True if the target file was built by the previous run from
+        exactly the same details, and still exists.
+        """
+        previous = self.previous.get(target_file)
+        if previous is None or not os.path.exists(target_file):
+            return False
+        return previous == self.normalise(entry)
+
+    def update(self, target_file, entry):
+        """
+        Records the details for the target file. Only files which are
+        recorded during the current build are kept when the manifest is
+        saved.
+        """
+        self.entries[target_file] = entry
+
+    def save(self):
+        """
+        Writes the manifest to the target directory.
+        """
+        import json
+        f = open(self.filename, "w")
+        f.write(json.dumps(self.entries, indent=4, separators=(',', ':'), sort_keys=True))
+        f.close()
+        # The saved entries are now the ones to compare against (this only
+        # matters in watch mode, where the same manifest is used again)
+        self.previous = self.normalise(self.entries)
     
+def gzip_compress(data):
+    """
+    Returns the data in gzip format. The header does not include a filename
+    or a time, so the same data always gives the same result.
+    """
+    import gzip
+    buffer = cStringIO.StringIO()
+    f = gzip.GzipFile("", "wb", GZIP_LEVEL, buffer, 0)
+    f.write(data)
+    f.close()
+    return buffer.getvalue()
+
+def compressors():
+    """
+    Returns a list of (extension, function) tuples for the compressed copies
+    of the pages: gzip, and brotli if the brotli module is installed.
+    """
+    result = [(".gz", gzip_compress)]
+    brotli = optional_module("brotli")
+    if brotli is not None:
+        result.append((".br", brotli.compress))
+    return result
+
+class KiwiCompressor():
+    """
+    Class to write the compressed copies of the pages on a pool of
+    background threads, so that compressing one page overlaps with
+    converting the next (zlib and brotli release the interpreter lock while
+    they compress). At most PIPELINE_DEPTH pages are held waiting to be
+    compressed. Any error is raised again by close().
+    """
+    def __init__(self, write, threads = COMPRESS_THREADS):
+        import threading
+        import Queue
+        # Function which writes the data to the file (Kiwi.replace_file)
+        self.write = write
+        self.queue = Queue.Queue(PIPELINE_DEPTH)
+        self.errors = []
+        self.threads = [threading.Thread(target = self.run) for i in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def add(self, filename, compress, data):
+        """
+        Queues the data to be compressed using the compress function and
+        written to the file.
+        """
+        self.queue.put((filename, compress, data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.errors:
+                continue
+            filename, compress, data = item
+            try:
+                self.write(filename, compress(data))
+            except Exception:
+                self.errors.append(sys.exc_info())
+
+    def close(self, raise_errors = True):
+        """
+        Waits for the queued files to be written and stops the threads,
+        raising the first error from any of the threads, unless
+        raise_errors is False.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors and raise_errors:
+            error_type, error, traceback = self.errors[0]
+            raise error_type, error, traceback
+
+class KiwiMinifier():
+    """
+    Class to minify HTML, one line at a time, without parsing the document.
+    Comments are removed, along with the indentation of each line and any
+    whitespace between tags. Line breaks and whitespace between tags are
+    removed completely next to block-level tags, and are otherwise reduced
+    to a single character, as they can be significant between inline
+    elements. The contents of the MINIFY_RAW_TAGS elements, and conditional
+    comments, are left exactly as they are.
+    """
+    def __init__(self):
+        # Patterns which match the end of each kind of element which is
+        # left alone, keyed by tag name
+        self.closing_patterns = dict((tag, re.compile(r"</%s\s*>" % tag, re.IGNORECASE)) for tag in MINIFY_RAW_TAGS)
+        self.closing_patterns["-->"] = re.compile("-->")
+
+    def minify(self, lines):
+        """
+        Generator which yields the minified version of the given lines.
+        """
+        self.raw = None
+        self.comment = False
+        pending = None
+        for line in lines:
+            text, starts_raw, ends_raw = self.minify_line(line)
+            if text is None:
+                continue
+            if pending is None:
+                pending = [text, ends_raw]
+            elif not starts_raw and not pending[1] and self.joins(pending[0], text):
+                pending[0] += text
+                pending[1] = ends_raw
+            else:
+                yield pending[0]
+                pending = [text, ends_raw]
+        if pending is not None:
+            yield pending[0]
+
+    def joins(self, previous, text):
+        """
+        Returns True if the line break between the two lines can be removed,
+        because one of them is next to a block-level tag.
+        """
+        match = LAST_TAG_PATTERN.search(previous)
+        if match and match.group(2).lower() in MINIFY_BLOCK_TAGS:
+            return True
+        match = FIRST_TAG_PATTERN.match(text)
+        return match is not None and match.group(1).lower() in MINIFY_BLOCK_TAGS
+
+    def minify_line(self, line):
+        """
+        Returns the minified line (or None if nothing is left of it), and
+        whether it starts and ends inside an element which is left alone.
+        """
+        starts_raw = self.raw is not None
+        segments = []
+        pos = 0
+        while True:
+            if self.comment:
+                end = line.find("-->", pos)
+                if end < 0:
+                    break
+                self.comment = False
+                pos = end + 3
+            elif self.raw:
+                match = self.closing_patterns[self.raw].search(line, pos)
+                if match is None:
+                    segments.append((line[pos:], True))
+                    break
+                segments.append((line[pos:match.end()], True))
+                self.raw = None
+                pos = match.end()
+            else:
+                match = MINIFY_PATTERN.search(line, pos)
+                if match is None:
+                    self.add_text(segments, line[pos:])
+                    break
+                self.add_text(segments, line[pos:match.start()])
+                if match.group(0) != "<!--":
+                    # The start (or a stray end) of an element which is
+                    # left alone
+                    segments.append((match.group(0), True))
+                    if not match.group(1):
+                        self.raw = match.group(2).lower()
+                elif line.startswith("<!--[", match.start()):
+                    # Conditional comments are kept
+                    segments.append((match.group(0), True))
+                    self.raw = "-->"
+                else:
+                    self.comment = True
+                pos = match.end()
+
+        if not segments:
+            return (None, starts_raw, self.raw is not None)
+        # Whitespace is only removed outside the elements left alone
+        if not segments[0][1]:
+            segments[0] = (segments[0][0].lstrip(), False)
+        if not segments[-1][1]:
+            segments[-1] = (segments[-1][0].rstrip(), False)
+        text = "".join(segment if raw else TAG_GAP_PATTERN.sub(self.tag_gap, segment) for segment, raw in segments)
+        if not text and not starts_raw:
+            return (None, starts_raw, self.raw is not None)
+        return (text, starts_raw, self.raw is not None)
+
+    def add_text(self, segments, text):
+        """
+        Adds text from outside the elements left alone to the segments of
+        the line, joining it to the previous segment if that is also
+        outside them (as when a comment between them has been removed), so
+        that whitespace on either side of the comment is treated as one gap.
+        """
+        if segments and not segments[-1][1]:
+            previous = segments[-1][0]
+            if previous[-1:].isspace():
+                text = text.lstrip()
+            segments[-1] = (previous + text, False)
+        else:
+            segments.append((text, False))
+
+    def tag_gap(self, match):
+        """
+        Returns the first tag of the match, with the whitespace after it
+        reduced (or removed, next to a block-level tag).
+        """
+        tag = match.group(0)[:match.start(3) - match.start()]
+        if match.group(2).lower() in MINIFY_BLOCK_TAGS or match.group(4).lower() in MINIFY_BLOCK_TAGS:
+            return tag
+        return tag + " "
+
+# Hashes of the source of modules, keyed by module name (see module_version)
+_module_versions = {}
+
+def module_version(module):
+    """
+    Returns the hash of the source of the module, which identifies its
+    version.
+    """
+    if module.__name__ not in _module_versions:
+        filename = os.path.splitext(module.__file__)[0] + ".py"
+        if not os.path.exists(filename):
+            filename = module.__file__
+        f = open(filename, "rb")
+        _module_versions[module.__name__] = hashlib.md5(f.read()).hexdigest()
+        f.close()
+    return _module_versions[module.__name__]
+
+def markup_version():
+    """
+    Returns a hash which identifies the version of KiwiMarkup, so that the
+    markup cache is not used for output from a different version.
+    """
+    return module_version(kiwimark)
+
+def kiwi_version():
+    """
+    Returns a hash which identifies the versions of Kiwi and KiwiMarkup, so
+    that incremental builds do not keep pages built by a different version.
+    """
+    return hashlib.md5(module_version(sys.modules[__name__]) + markup_version()).hexdigest()
+
+class KiwiMarkupCache():
+    """
+    Class to hold the on-disk cache of converted markup. Each entry holds the
+    lines produced by KiwiMarkup for a source file, in a file named after
+    the hash of the source and of the KiwiMarkup version, so that the
+    directory can safely be shared between different builds. Using an entry
+    updates its modification time, and when the directory grows beyond
+    size_limit bytes the least recently used entries are removed.
+    """
+    def __init__(self, directory, size_limit = MARKUP_CACHE_SIZE * 1024 * 1024, variant = ""):
+        self.directory = directory
+        self.size_limit = size_limit
+        # Anything else which affects the output of KiwiMarkup, such as the
+        # syntax highlighter, so that it is included in the keys
+        self.variant = variant
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def counts(self):
+        return (self.hits, self.misses, self.writes, self.evictions)
+
+    def merge(self, counts):
+        """
+        Adds the counts from another instance (from a worker process).
+        """
+        self.hits += counts[0]
+        self.misses += counts[1]
+        self.writes += counts[2]
+        self.evictions += counts[3]
+
+    def key(self, lines):
+        """
+        Returns the cache key for the given source lines.
+        """
+        source = hashlib.md5(markup_version() + self.variant)
+        for line in lines:
+            source.update(line)
+        return source.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns the cached lines for the key, or None if there is no entry.
+        """
+        filename = self.filename(key)
+        try:
+            f = open(filename, "rb")
+            try:
+                header = f.readline()
+                content = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        # The header holds the number of lines, which guards against
+        # damaged entries
+        lines = content.split("\n")
+        if header.strip() != str(len(lines)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Mark the entry as recently used. This fails if the directory is
+        # read-only, or the entry belongs to another user, in which case
+        # the entry is still used but may be evicted sooner.
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return lines
+
+    def put(self, key, lines):
+        """
+        Stores the lines for the key. The entry is written to a temporary
+        file first, so that other builds sharing the directory never see a
+        partly written entry. Failing to write the entry is not an error.
+        """
+        content = "\n".join(lines)
+        if content.count("\n") + 1 != len(lines):
+            # The lines cannot be split apart again
+            return
+        filename = self.filename(key)
+        directory = os.path.dirname(filename)
+        temp_file = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            temp_file = temp_filename(directory)
+            f = os.fdopen(os.open(temp_file, TEMP_FILE_FLAGS, 0666), "wb")
+            f.write("%d\n" % len(lines))
+            f.write(content)
+            f.close()
+            if os.name == "nt" and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temp_file, filename)
+            self.writes += 1
+        except (IOError, OSError):
+            if temp_file and os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    def trim(self):
+        """
+        Removes the least recently used entries until the cache is no larger
+        than size_limit bytes.
+        """
+        entries = []
+        total = 0
+        for directory, names, filenames in os.walk(self.directory):
+            for name in filenames:
+                filename = os.path.join(directory, name)
+                try:
+                    info = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, filename))
+                total += info.st_size
+        if total <= self.size_limit:
+            return
+        for mtime, size, filename in sorted(entries):
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self.evictions += 1
+            total -= size
+            if total <= self.size_limit:
+                break
+
+    def report(self):
+        print "Markup cache: %d hits, %d misses, %d evicted" % (self.hits, self.misses, self.evictions)
+
 class Kiwi():
     """
     Main processor class, with Kiwi.execute() as the entry-point.
     """
     def __init__(self):
         self.marker = kiwimark.KiwiMarkup()
+        self.manifest = None
+        self.profile = None
+        self.markup_cache = None
+        self.compressor = None
+        self.minifier = KiwiMinifier()
+        self.build_time = datetime.datetime.now()
+        self.dates = {}
+        self.tag_patterns = {}
+        self.tags = {}
 
     def execute(self, params):
         """
@@ -259,46 +1433,792 @@ class Kiwi():
         params - docopt object containing command-line parameters
         """
         self.params = params
+        self.arguments = params
+        self.build_time = datetime.datetime.now()
+        self.dates = {}
+        self.tags = {}
         self.open_kiwi_file()
         self.verbose = self.params["--verbose"]
         self.pages = KiwiPageList()
-        
-        self.prepare_template()
-        if self.prepare_source_path():
-            if self.prepare_target_path():
-                self.process_files()
+
+        # If requested, record the timings of the build. These are left in
+        # self.profile (see KiwiProfile.results) for use by the caller.
+        self.profile = None
+        profiler = None
+        if self.params.get("--profile"):
+            self.profile = KiwiProfile()
+            if self.params.get("--pstats"):
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+
+        self.build()
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(self.params["--pstats"])
+        if self.profile:
+            self.profile.report(int(self.params.get("--slowest") or 10))
 
         # If requested, save the config file into the source path
         if self.params["--savefile"]:
+            import json
             f = open(os.path.join(self.source_path, self.params["--savefile"][0] + ".kiwi"), "w")
             self.params["--savefile"] = None
             f.write(json.dumps(self.params, indent=4, separators=(',', ':')))
             f.close()
+
+        if self.params.get("--watch"):
+            self.watch()
                 
         return True
 
+    def build(self):
+        """
+        Builds the site, using the details in self.params.
+        """
+        self.prepare_template()
+        self.prepare_highlighter()
+        self.prepare_markup_cache()
+        if int(self.params.get("--jobs") or 1) != 1 or self.params.get("--pipeline"):
+            # The pages are converted by worker processes, or read ahead by
+            # a background thread (see process_pages_in_pipeline), which
+            # read the source files themselves, so only the titles are
+            # needed here
+            self.pages.cache_limit = 0
+        if self.prepare_source_path():
+            if self.prepare_target_path():
+                self.process_files()
+
+    def start_compressor(self):
+        """
+        Starts the threads which write the compressed copies of the pages,
+        if the compress option was given.
+        """
+        if self.params.get("--compress") and self.compressor is None:
+            self.compressor = KiwiCompressor(self.replace_file)
+
+    def stop_compressor(self, raise_errors = True):
+        """
+        Waits for the compressed copies of the pages to be written.
+        """
+        compressor, self.compressor = self.compressor, None
+        if compressor is not None:
+            compressor.close(raise_errors)
+
+    def stage(self, name, function, *args):
+        """
+        Calls the function with the given arguments and returns the result,
+        recording the time taken against the named stage of the build if
+        the build is being profiled.
+        """
+        if self.profile is None:
+            return function(*args)
+        start = timeit.default_timer()
+        try:
+            return function(*args)
+        finally:
+            self.profile.record(name, timeit.default_timer() - start)
+
     def process_files(self):
         """
         Main processing routine.
         """
-        # Sort the pages.
+        self.sort_pages()
+        self.start_compressor()
+        try:
+            self.process_all_files()
+        except:
+            self.stop_compressor(False)
+            raise
+        self.stop_compressor()
+
+    def process_all_files(self):
+        """
+        Writes the index (if requested) and all the pages.
+        """
+        if self.params["--contents"]:
+            self.stage("index", self.create_index)
+
+        # Only pages whose details differ from the previous build are
+        # processed when an incremental build is requested.
+        self.manifest = None
+        if self.params.get("--incremental"):
+            self.manifest = KiwiManifest(self.target_path)
+
+        jobs = int(self.params.get("--jobs") or 1)
+        if jobs == 0:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        if jobs > 1 and len(self.pages.files) > 1:
+            results = self.process_pages_in_parallel(jobs)
+        elif self.params.get("--pipeline"):
+            results = self.process_pages_in_pipeline()
+        else:
+            results = [self.process_page(page) for page in self.pages.files]
+
+        self.record_results(results)
+
+    def record_results(self, results):
+        """
+        Records the results from process_page() in the build manifest (for
+        incremental builds), and reports how many of the pages actually
+        changed. The number is also kept in self.changed_files.
+        """
+        if self.manifest:
+            for target_file, entry, changed in results:
+                self.manifest.update(target_file, entry)
+            self.manifest.save()
+        if self.markup_cache and self.markup_cache.writes:
+            self.markup_cache.trim()
+        self.changed_files = len([result for result in results if result[2]])
+        if self.verbose:
+            print "%d of %d pages changed" % (self.changed_files, len(results))
+            if self.markup_cache:
+                self.markup_cache.report()
+
+    def serve(self, params):
+        """
+        Entry point for the preview web-server, which converts pages when
+        they are requested instead of writing them to disk.
+
+        params - docopt object containing command-line parameters
+        """
+        self.prepare_server(params)
+
+        port = int(self.arguments.get("--port") or SERVE_PORT)
+        import BaseHTTPServer
+        import kiwiserve
+        server = BaseHTTPServer.HTTPServer(("localhost", port), kiwiserve.KiwiRequestHandler)
+        server.kiwi = self
+        print "Serving %s at http://localhost:%d/ (press Ctrl+C to stop)" % (self.source_path, port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        return True
+
+    def prepare_server(self, params):
+        """
+        Reads the titles of the source files for the preview web-server,
+        ready for render_index and render_link.
+
+        params - docopt object containing command-line parameters
+        """
+        self.params = params
+        self.arguments = params
+        self.tags = {}
+        self.open_kiwi_file()
+        self.verbose = self.params["--verbose"]
+        self.pages = KiwiPageList()
+        # Only the titles are needed until the pages are requested
+        self.pages.cache_limit = 0
+        self.target_path = ""
+        self.prepare_template()
+        self.prepare_highlighter()
+        self.prepare_source_path()
+        self.sort_pages()
+        self.index_links()
+        self.page_versions = self.source_versions()
+        self.source_directories = self.source_directory_times()
+        self.pages_checked = time.time()
+        self.cache = KiwiRenderCache(int(self.arguments.get("--cache") or SERVE_CACHE_SIZE))
+
+    def index_links(self):
+        """
+        Rebuilds the lookup of pages by their link (the name of the HTML
+        file), used by the preview web-server.
+        """
+        self.links = {}
+        for page in self.pages.files:
+            self.links[self.pages.relative_target(page.source_file).replace(os.sep, "/")] = page
+
+    def refresh_template(self):
+        """
+        Reloads the template if it has changed, discarding any pages that
+        were converted using the previous template.
+        """
+        template = self.template
+        self.prepare_template()
+        if self.template is not template:
+            self.cache.clear()
+
+    def render_index(self):
+        """
+        Returns the index page, for the preview web-server.
+        """
+        self.refresh_template()
+        self.refresh_pages(True)
+        self.build_time = datetime.datetime.now()
+        self.dates = {}
+        self.build_index()
+        return "\n".join(self.output)
+
+    def render_link(self, link):
+        """
+        Returns the converted page for the given link, for the preview
+        web-server, or None if there is no such page. Pages are converted
+        when they are first requested, and are then kept in the cache until
+        their source file changes.
+        """
+        self.refresh_template()
+        self.refresh_pages()
+        page = self.links.get(link)
+        if page is None:
+            # The page may have been added since the last scan
+            self.refresh_pages(True)
+            page = self.links.get(link)
+        if page is None:
+            return None
+        try:
+            info = os.stat(page.source_file)
+        except OSError:
+            return None
+        version = (info.st_mtime, info.st_size)
+        html = self.cache.get(page.source_file, version)
+        if html is None:
+            # The file may have changed, so re-read its title, in case this
+            # affects the order of the pages and hence the page-navigation
+            # links of the other pages
+            self.page_versions[page.source_file] = version
+            if self.reread_pages([page.source_file]):
+                self.pages.sort_by_file()
+                self.sort_pages()
+                self.cache.clear()
+            self.index_links()
+            page = self.pages.files[self.pages.position(page.source_file)]
+            self.build_time = datetime.datetime.now()
+            self.dates = {}
+            html = self.render_page(page)
+            self.cache.put(page.source_file, version, html)
+        return html
+
+    def refresh_pages(self, force = False):
+        """
+        Brings the list of pages up to date with the source files, for the
+        preview web-server, adding new files, removing deleted ones and
+        re-reading the titles of files whose size or modification time has
+        changed. If the list or any of the titles change, the cached pages
+        are discarded, as their page-navigation links may no longer be
+        right.
+
+        Scanning the source files takes a while for large sites, so unless
+        force is True they are only scanned if the modification time of one
+        of the source directories has changed, or if SERVE_RESCAN_INTERVAL
+        seconds have passed since the last scan (as a change in a new
+        sub-directory does not change the time of any known directory).
+        """
+        directories = self.source_directory_times()
+        if not force and directories == self.source_directories and time.time() - self.pages_checked < SERVE_RESCAN_INTERVAL:
+            return
+        sources = self.find_source_files()
+        self.source_directories = self.source_directory_times()
+        self.pages_checked = time.time()
+        versions = self.source_versions()
+        current = set(sources)
+        removed = [page.source_file for page in self.pages.files if page.source_file not in current]
+        added = [source_file for source_file in sources if source_file not in self.pages]
+        changed = [source_file for source_file in sources
+                   if source_file in self.pages and versions[source_file] != self.page_versions.get(source_file)]
+        self.page_versions = versions
+        retitled = self.reread_pages(changed)
+        if removed or added or retitled:
+            for source_file in removed:
+                self.pages.remove(source_file)
+            for source_file in added:
+                self.pages.add(source_file)
+            # New pages are added at the end of the list, so put the pages
+            # back in the order that a full build would give them
+            self.pages.sort_by_file()
+            self.sort_pages()
+            self.index_links()
+            self.cache.clear()
+
+    def reread_pages(self, source_files):
+        """
+        Reads the titles of the given pages again, after their files have
+        changed. Returns True if any of the titles changed, in which case the
+        pages may need to be sorted again.
+        """
+        retitled = False
+        for source_file in source_files:
+            title = self.pages.files[self.pages.position(source_file)].title
+            self.pages.refresh(source_file)
+            if self.pages.files[self.pages.position(source_file)].title != title:
+                retitled = True
+        return retitled
+
+    def source_versions(self):
+        """
+        Returns a dictionary of the (modification time, size) of the source
+        files found by the last scan, keyed by filename, for detecting files
+        which have changed since their titles were read.
+        """
+        versions = {}
+        for filename, info in self.source_stats.items():
+            versions[filename] = (info.st_mtime, info.st_size)
+        return versions
+
+    def source_directory_times(self):
+        """
+        Returns a dictionary of the modification times of the directories
+        holding the source files found by the last scan, and of the source
+        path (or of its directory, if it is a pattern), keyed by directory.
+        Directories which no longer exist are omitted.
+        """
+        if os.path.isdir(self.source_path):
+            directories = set([self.source_path])
+        else:
+            directories = set([os.path.dirname(self.source_path) or os.curdir])
+        directories.update(os.path.dirname(filename) for filename in self.source_stats)
+        times = {}
+        for directory in directories:
+            try:
+                times[directory] = os.stat(directory).st_mtime
+            except OSError:
+                pass
+        return times
+
+    def render_page(self, page):
+        """
+        Converts a single page and returns it, without writing it to disk.
+        """
+        self.load_file(page)
+        self.preprocess_file()
+        self.apply_markup()
+        self.apply_template()
+        self.postprocess_file(page.source_file)
+        return "\n".join(self.output)
+
+    def render_pages(self, sources, template = None, tags = None, title = "", sort = None):
+        """
+        Converts pages in memory, without reading or writing any files, and
+        returns the HTML for each page as a list of (name, html) tuples, in
+        the order of the pages.
+
+        sources  - iterable of (name, text) tuples, one for each page. The
+                   names take the place of the source filenames, and are
+                   used for the page-navigation links (for example, the
+                   page named "notes/a.txt" is linked to as "notes/a.html")
+        template - template text, or a KiwiTemplate instance (which avoids
+                   splitting the same template again for every call). The
+                   default template is used if this is None
+        tags     - dictionary of meta-data values, such as {"@@CSS": "a.css"},
+                   used for any tags which a page does not declare itself
+        title    - the default value of @@TITLE
+        sort     - "title" or "file" to sort the pages, as with the
+                   --sortbytitle and --sortbyfile options, otherwise the
+                   pages are kept in the given order
+
+        The text can be given as utf-8 or as Unicode. The HTML is returned
+        as utf-8.
+        """
+        self.params = {"--sortbytitle": sort == "title", "--sortbyfile": sort == "file"}
+        self.arguments = self.params
+        self.verbose = False
+        self.profile = None
+        self.build_time = datetime.datetime.now()
+        self.dates = {}
+        self.title = self.to_utf8(title)
+        self.tags = {}
+        for tag, value in (tags or {}).iteritems():
+            tag = self.to_utf8(tag)
+            if not tag.startswith("@@"):
+                tag = "@@" + tag
+            self.tags[tag] = self.to_utf8(value)
+
+        if template is None:
+            self.template = default_template()
+        elif isinstance(template, KiwiTemplate):
+            self.template = template
+        else:
+            self.template = KiwiTemplate(self.to_utf8(template))
+
+        self.pages = KiwiPageList()
+        self.target_path = ""
+        for name, text in sources:
+            self.pages.add_text(self.to_utf8(name), self.to_utf8(text))
+        self.sort_pages()
+
+        return [(page.source_file, self.render_page(page)) for page in list(self.pages.files)]
+
+    def read_static_file(self, filename):
+        """
+        Returns the contents of a file from the source directory, or None if
+        there is no such file (or the name refers to a file outside the
+        source directory).
+        """
+        if os.path.isdir(self.source_path):
+            directory = self.source_path
+        else:
+            directory = os.path.dirname(self.source_path)
+        path = os.path.normpath(os.path.join(directory, filename))
+        if not path.startswith(directory + os.sep) or not os.path.isfile(path):
+            return None
+        f = open(path, "rb")
+        content = f.read()
+        f.close()
+        return content
+
+    def sort_pages(self):
+        """
+        Sorts the pages, if a sort order was requested.
+        """
         if self.params["--sortbytitle"]:
             self.pages.sort_by_title()
         elif self.params["--sortbyfile"]:
             self.pages.sort_by_file()    
 
+    def watch(self):
+        """
+        Keeps watching the source files, the template and the .kiwi file
+        for changes, rebuilding whatever is affected, until interrupted.
+        """
+        watcher = KiwiWatcher()
+        watcher.watch_directories(self.watched_directories())
+        files = watcher.snapshot(self.watched_files(), self.source_stats)
+        print "Watching for changes (press Ctrl+C to stop)"
+        try:
+            while True:
+                if not watcher.wait():
+                    continue
+                current = watcher.snapshot(self.watched_files(), self.source_stats)
+                if current != files:
+                    changed = set(filename for filename in current if files.get(filename) != current[filename])
+                    removed = set(files) - set(current)
+                    self.rebuild(changed, removed)
+                    watcher.watch_directories(self.watched_directories())
+                    files = watcher.snapshot(self.watched_files(), self.source_stats)
+        except KeyboardInterrupt:
+            pass
+
+    def watched_files(self):
+        """
+        Returns a list of the files which are watched for changes.
+        """
+        filenames = self.find_source_files()
+        if self.params["--template"]:
+            filenames.append(self.params["--template"])
+        if self.config_file:
+            filenames.append(self.config_file)
+        return filenames
+
+    def watched_directories(self):
+        """
+        Returns a list of the directories which hold the watched files.
+        """
+        if os.path.isdir(self.source_path):
+            directories = [self.source_path]
+        else:
+            directories = [os.path.dirname(self.source_path)]
+        for filename in (self.params["--template"], self.config_file):
+            if filename:
+                directories.append(os.path.dirname(os.path.abspath(filename)))
+        return [directory for directory in directories if os.path.isdir(directory)]
+
+    def rebuild(self, changed, removed):
+        """
+        Rebuilds the pages affected by changes to the given files.
+        """
+        self.start_compressor()
+        try:
+            self.rebuild_files(changed, removed)
+        except:
+            self.stop_compressor(False)
+            raise
+        self.stop_compressor()
+
+    def rebuild_files(self, changed, removed):
+        """
+        Rebuilds the pages affected by changes to the given files, for
+        rebuild().
+        """
+        # The rebuilt pages get the date of the rebuild, not of the first
+        # build, as the session may run for days
+        self.build_time = datetime.datetime.now()
+        self.dates = {}
+        if self.config_file in changed:
+            # Start again, using the new configuration
+            self.params = self.arguments
+            self.open_kiwi_file()
+            self.verbose = self.params["--verbose"]
+            self.pages = KiwiPageList()
+            self.build()
+            return
+
+        navigation = self.navigation_links()
+        contents = [(self.pages.link(page), page.title) for page in self.pages.files]
+
+        sources = set(self.find_source_files())
+        for source_file in removed:
+            self.pages.remove(source_file)
+        for source_file in changed:
+            if source_file in sources:
+                self.pages.refresh(source_file)
+        # New pages are added at the end of the list, so put the pages back
+        # in the order that a full build would give them
+        self.pages.sort_by_file()
+        self.sort_pages()
+
+        template_changed = self.params["--template"] in changed or self.params["--template"] in removed
+        if template_changed:
+            self.prepare_template()
+            affected = self.pages.files
+        else:
+            # The changed pages, and any pages whose page-navigation links
+            # are now different
+            links = self.navigation_links()
+            affected = [page for page in self.pages.files
+                        if page.source_file in changed or navigation.get(page.source_file) != links[page.source_file]]
+
         if self.params["--contents"]:
-            self.create_index()
-            
-        for page in self.pages.files:
-            if self.verbose:
-                print page.source_file
-            self.load_file(page.source_file)
-            self.preprocess_file()
-            self.apply_markup()
-            self.apply_template()
-            self.postprocess_file(page.source_file)
-            self.write_page(page.source_file)
+            if template_changed or contents != [(self.pages.link(page), page.title) for page in self.pages.files]:
+                self.create_index()
+
+        results = [self.process_page(page) for page in affected]
+        self.record_results(results)
+
+    def navigation_links(self):
+        """
+        Returns the links to the previous and next pages for every page,
+        keyed by source file.
+        """
+        files = self.pages.files
+        links = {}
+        for idx, page in enumerate(files):
+            preceding = self.pages.link(files[idx - 1]) if idx > 0 else ""
+            following = self.pages.link(files[idx + 1]) if idx + 1 < len(files) else ""
+            links[page.source_file] = (preceding, following)
+        return links
+
+    def process_page(self, page):
+        """
+        Converts a single page and writes it to the target folder. Returns
+        the target filename, the manifest entry for the page (which will
+        be None unless this is an incremental build), and whether the target
+        file was changed.
+        """
+        start = timeit.default_timer()
+        self.stage("load", self.load_file, page)
+        target_file, entry, current = self.check_page(page)
+        if current:
+            return (target_file, entry, False)
+        self.convert_page(page)
+        changed = self.stage("write", self.write_page, page.source_file)
+        if self.profile:
+            self.profile.record_page(page.source_file, timeit.default_timer() - start)
+        return (target_file, entry, changed)
+
+    def check_page(self, page):
+        """
+        Returns the target filename and the manifest entry for the page
+        (which will be None unless this is an incremental build), and
+        whether the existing target file is still current, so that the page
+        does not need to be converted. The page must already be loaded.
+        """
+        target_file = self.target_filename(page.source_file)
+        entry = None
+        if self.manifest:
+            entry = self.stage("manifest", self.manifest_entry, page)
+            if self.manifest.is_current(target_file, entry):
+                return (target_file, entry, True)
+        return (target_file, entry, False)
+
+    def convert_page(self, page):
+        """
+        Converts the loaded page, leaving the final HTML in self.output.
+        """
+        if self.verbose:
+            print page.source_file
+        self.preprocess_file()
+        self.stage("markup", self.apply_markup)
+        self.stage("template", self.apply_template)
+        self.stage("postprocess", self.postprocess_file, page.source_file)
+        if self.params.get("--minify"):
+            self.stage("minify", self.minify_output)
+
+    def process_pages_in_pipeline(self):
+        """
+        Converts the pages one after another, as process_page() does, but
+        with the source files read ahead by a background thread and the
+        pages written by a pool of background threads, so that the file
+        reads and writes overlap with the conversion. The queues between
+        the threads are limited to PIPELINE_DEPTH pages, so that only a few
+        pages are held in memory at any one time.
+
+        The background threads record their timings in their own
+        KiwiProfile instances, which are added to self.profile at the end.
+        """
+        import threading
+        import Queue
+        files = self.pages.files
+        read_queue = Queue.Queue(PIPELINE_DEPTH)
+        write_queue = Queue.Queue(PIPELINE_DEPTH)
+        changes = [False] * len(files)
+        errors = []
+        stop = threading.Event()
+        profiles = []
+
+        def new_profile():
+            profile = None
+            if self.profile is not None:
+                profile = KiwiProfile()
+                profiles.append(profile)
+            return profile
+
+        def read():
+            profile = new_profile()
+            try:
+                for page in files:
+                    if stop.is_set():
+                        break
+                    start = timeit.default_timer()
+                    lines = self.pages.read_lines(page)
+                    if profile:
+                        seconds = timeit.default_timer() - start
+                        profile.record("load", seconds)
+                        profile.record_page(page.source_file, seconds)
+                    read_queue.put(lines)
+            except Exception:
+                errors.append(sys.exc_info())
+            read_queue.put(None)
+
+        def write():
+            profile = new_profile()
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    break
+                idx, source_file, target_file, output = item
+                if errors:
+                    continue
+                try:
+                    start = timeit.default_timer()
+                    changes[idx] = self.write_output(target_file, output)
+                    if profile:
+                        seconds = timeit.default_timer() - start
+                        profile.record("write", seconds)
+                        profile.record_page(source_file, seconds)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target = read)]
+        threads.extend(threading.Thread(target = write) for i in range(PIPELINE_WRITERS))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        results = []
+        try:
+            for idx, page in enumerate(files):
+                lines = read_queue.get()
+                if lines is None:
+                    break
+                start = timeit.default_timer()
+                self.input = lines
+                target_file, entry, current = self.check_page(page)
+                results.append((target_file, entry))
+                if not current:
+                    self.convert_page(page)
+                    write_queue.put((idx, page.source_file, target_file, "\n".join(self.output)))
+                if self.profile:
+                    self.profile.record_page(page.source_file, timeit.default_timer() - start)
+        finally:
+            # Make sure that the reader is not left waiting for room in its
+            # queue, and tell the writers to finish once the queue is empty
+            stop.set()
+            while threads[0].is_alive():
+                try:
+                    read_queue.get(timeout = 0.1)
+                except Queue.Empty:
+                    pass
+            for thread in threads[1:]:
+                write_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+        if self.profile:
+            for profile in profiles:
+                self.profile.merge(profile)
+        return [(target_file, entry, changes[idx]) for idx, (target_file, entry) in enumerate(results)]
+
+    def process_pages_in_parallel(self, jobs):
+        """
+        Converts the pages using a pool of worker processes. Each worker is
+        given a copy of the build details, including the complete (sorted)
+        list of pages, so that the page-navigation links are the same as
+        they would be if the pages were processed one after another.
+        """
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, init_worker, (self.worker_state(),))
+        try:
+            chunk_size = max(1, len(self.pages.files) // (jobs * 4))
+            results = pool.map(process_page_worker, range(len(self.pages.files)), chunk_size)
+        finally:
+            pool.close()
+            pool.join()
+        # Each result includes the timings from the worker, if the build is
+        # being profiled, and its markup cache counts.
+        for result, profile, counts in results:
+            if self.profile:
+                self.profile.merge(profile)
+            if self.markup_cache:
+                self.markup_cache.merge(counts)
+        return [result for result, profile, counts in results]
+
+    def worker_state(self):
+        """
+        Returns the details which a worker process needs in order to convert
+        pages on behalf of this instance. See init_worker().
+        """
+        return {
+            "params": self.params,
+            "verbose": self.verbose,
+            "template": self.template,
+            "title": self.title,
+            "build_time": self.build_time,
+            "source_path": self.source_path,
+            "target_path": self.target_path,
+            "source_root": self.pages.source_root,
+            "files": self.pages.files,
+            "manifest": self.manifest,
+            "markup_cache": self.markup_cache,
+            "profile": self.profile is not None
+        }
+
+    def manifest_entry(self, page):
+        """
+        Returns the details that the output of the current file depends on,
+        for recording in the build manifest. The file must already have been
+        loaded.
+        """
+        source = "".join(self.input)
+        entry = {
+            "version": kiwi_version(),
+            "source": hashlib.md5(source).hexdigest(),
+            "template": self.template.hash,
+            "tags": {"@@TITLE": self.title},
+            "nav": []
+        }
+        # The date and the navigation links only matter to pages which
+        # actually use them.
+        if "@@DATE" in source or "@@DATE" in self.template.text:
+            entry["tags"]["@@DATE"] = self.build_time.date().isoformat()
+        if "@@PAGE-NAV" in source or "@@PAGE-NAV" in self.template.text:
+            entry["nav"] = [self.pages.link(adjacent) if adjacent else "" for adjacent in self.pages.adjacent_files(page.source_file)]
+        # So that the compressed copies are written if they are asked for,
+        # and the pages are rebuilt if the minify option changes
+        if self.params.get("--compress"):
+            entry["compress"] = [extension for extension, compress in compressors()]
+        if self.params.get("--minify"):
+            entry["minify"] = True
+        if self.marker.highlighter:
+            entry["highlight"] = self.marker.highlighter.version()
+        return entry
 
     def to_utf8(self, input):
         """
@@ -324,10 +2244,13 @@ class Kiwi():
         and if so, opens it and replaces the current params array with
         the contents of the file.
         """
+        self.config_file = None
         kiwi_file = self.params["SOURCE"]
         if (kiwi_file is not None) and os.path.exists(kiwi_file):
             filename, ext = os.path.splitext(kiwi_file)
             if ext == ".kiwi":
+                import json
+                self.config_file = kiwi_file
                 f = open(kiwi_file)
                 self.params = json.loads(f.read())
                 f.close()
@@ -340,16 +2263,34 @@ class Kiwi():
         inserted into. If no template file was specified on the command
         line, a simple internal template is used instead.
         """
-        self.template = DEFAULT_PAGE_TEMPLATE
+        self.template = default_template()
         if self.params["--template"] != None:
             template_file = self.params["--template"]
             if os.path.exists(template_file):
-                f = open(template_file)
-                self.template = f.read()
-                f.close
+                self.template = load_template(template_file)
             elif self.verbose:
                 print "Template file %s not found, using default instead." % template_file
 
+    def prepare_highlighter(self):
+        """
+        Sets up the syntax highlighting of code blocks, if it was requested.
+        """
+        self.marker.highlighter = None
+        if self.params.get("--highlight"):
+            self.marker.highlighter = kiwimark.KiwiHighlighter()
+
+    def prepare_markup_cache(self):
+        """
+        Prepares the markup cache, if a cache directory was specified.
+        """
+        self.markup_cache = None
+        if self.params.get("--cachedir"):
+            size = int(self.params.get("--cachesize") or MARKUP_CACHE_SIZE)
+            variant = ""
+            if self.marker.highlighter:
+                variant = self.marker.highlighter.version()
+            self.markup_cache = KiwiMarkupCache(os.path.abspath(self.params["--cachedir"]), size * 1024 * 1024, variant)
+
     def prepare_source_path(self):
         """
         Sets the source path, either from the command-line
@@ -365,20 +2306,39 @@ class Kiwi():
         else:
             self.source_path = os.getcwd()
         self.title = os.path.split(self.source_path)[1].title()
-        
         if os.path.isdir(self.source_path):
-            source_files = glob.glob(os.path.join(self.source_path, "*.txt"))
-            source_files.extend(glob.glob(os.path.join(self.source_path, "*.md")))
-        else:
+            self.pages.source_root = self.source_path
+        
+        if not os.path.isdir(self.source_path):
             filename, ext = os.path.splitext(self.title)
             self.title = filename.title()
-            source_files = glob.glob(self.source_path)
             
-        for filespec in source_files:
-            self.pages.add(filespec)
+        for filespec in self.find_source_files():
+            self.stage("scan", self.pages.add, filespec)
         
         return (len(self.pages.files) > 0)
 
+    def find_source_files(self):
+        """
+        Returns a list of the source files, in order of their names: the
+        files in the source path which match the include patterns (.txt and
+        .md files by default) if it is a directory, otherwise the files that
+        match the source path. The os.stat() details of the files are kept
+        in self.source_stats, for detecting changes.
+        """
+        if os.path.isdir(self.source_path):
+            include = (self.params.get("--include") or SOURCE_PATTERNS).split(",")
+            exclude = (self.params.get("--exclude") or "").split(",")
+            self.source_stats = scan_directory(self.source_path,
+                [pattern.strip() for pattern in include if pattern.strip()],
+                [pattern.strip() for pattern in exclude if pattern.strip()],
+                self.params.get("--recursive"), self.target_directory())
+        else:
+            self.source_stats = {}
+            for filename in glob.glob(self.source_path):
+                self.source_stats[filename] = os.stat(filename)
+        return sorted(self.source_stats)
+
     def prepare_target_path(self):
         """
         Prepares the path that the final HTML files will be written to. Uses
@@ -387,22 +2347,28 @@ class Kiwi():
         source was a single file, in which case it defaults to the directory
         of the source file. The directory is created if it does not exist.
         """
-        if self.params["--target"]:
-            self.target_path = os.path.abspath(self.params["--target"])
-        else:
-            if os.path.isdir(self.source_path):
-                self.target_path = os.path.join(self.source_path, "html")
-            else:
-                self.target_path = os.path.dirname(os.path.abspath(self.source_path))
+        self.target_path = self.target_directory()
         if not os.path.exists(self.target_path):
             os.makedirs(self.target_path)
         self.pages.target_path = self.target_path
         return True
 
-    def load_file(self, source_file):
-        f = open(source_file)
-        self.input = f.readlines()
-        f.close()
+    def target_directory(self):
+        """
+        Returns the path that the final HTML files will be written to (see
+        prepare_target_path).
+        """
+        if self.params.get("--target"):
+            return os.path.abspath(self.params["--target"])
+        if os.path.isdir(self.source_path):
+            return os.path.join(self.source_path, "html")
+        return os.path.dirname(os.path.abspath(self.source_path))
+
+    def load_file(self, page):
+        """
+        Loads the source file for the given page into self.input.
+        """
+        self.input = self.pages.read_lines(page)
 
     def create_index(self):
         """
@@ -410,6 +2376,13 @@ class Kiwi():
         other files. This also builds the list of files that will be used
         for any page-navigation tags.
         """
+        self.build_index()
+        self.write_page(os.path.join(self.source_path, "index.txt"))
+
+    def build_index(self):
+        """
+        Builds the contents of the index.html file in self.output.
+        """
         self.input = []
 
         # Create a UL list, adding a LI tag with a link to the file for each
@@ -417,12 +2390,13 @@ class Kiwi():
         self.input.append("<h2>Contents</h2>")
         self.input.append("<ul>")
         for page in self.pages.files:
-            self.input.append("<li><a href='%s'>%s</a></li>" % (page.link, page.title))
+            self.input.append("<li><a href='%s'>%s</a></li>" % (self.pages.link(page), page.title))
         self.input.append("</ul>")
 
         self.apply_template()
         self.postprocess_file(os.path.join(self.source_path, "index.txt"))
-        self.write_page(os.path.join(self.target_path, "index.html"))
+        if self.params.get("--minify"):
+            self.minify_output()
         
     def preprocess_file(self):
         """
@@ -436,87 +2410,120 @@ class Kiwi():
         """
         Applies any meta-data elements to the current file.
 
-        TODO: This function is messy and unclear, and needs redesigning.
+        This is done in two passes. The first pass collects the tag
+        declarations, removing them from the output, and resolves the
+        system tags. The second pass replaces every occurrence of the tags
+        in a single scan of each line, using one compiled pattern for all
+        the tag names.
         """
-        # Search for user-defined tag declarations
-        user_tags = []
-        system_tags = ["@@PAGE-NAV", "@@DATE"]
-        
-        # RegEx to split the tag into three parts. Only the first and third
-        # are used, and are the tag name and replacement text respectively
-        # (except for @@DATE tags, where the third part is the date format
-        # string).
-        pattern = re.compile('(@@[a-zA-Z0-9_-]+)(:("[^"]*"))?', re.IGNORECASE)
+        user_tags = {}
+
+        def declare(match):
+            # The pattern splits the tag into three parts. Only the first and
+            # third are used, and are the tag name and replacement text
+            # respectively (except for @@DATE tags, where the third part is
+            # the date format string).
+            tag = match.group(1)
+            value = match.group(3)
+            replacement = ""
+            if tag == "@@PAGE-NAV":
+                replacement = self.page_navigation(source_file)
+            elif tag == "@@DATE":
+                if value:
+                    # We've been given a date format. Strip the double-quotes
+                    replacement = self.formatted_date(value[1:-1])
+                else:
+                    # There's no date format, so use the default
+                    replacement = self.formatted_date("%d %B %Y")
+            elif value:
+                # Strip off the double-quotes
+                replacement = value[1:-1]
+
+                # Handle system-defined tags
+                if tag == "@@TITLE":
+                    if replacement == "":
+                        replacement = self.title
+
+            if replacement == "":
+                # This is simply a reference to the tag
+                return match.group(0)
+
+            # The first declaration of a tag is the one which is used
+            user_tags.setdefault(tag, replacement.strip())
+
+            # Remove the tag declaration, leaving system tags in place so
+            # that they will be replaced along with any other occurrences.
+            if tag in SYSTEM_TAGS:
+                return tag
+            return ""
 
         for i in range(0, len(self.output)):
-            match = re.search(pattern, self.output[i])
-            if match:
-                tag = match.group(1)
-                replacement = ""
-                
-                if tag == "@@PAGE-NAV":
-                    navigation = ""
-                    element = "<a class='page-nav page-%s' href='%s'>%s</a>"
-                    
-                    adjacent_files = self.pages.adjacent_files(source_file)
-                    
-                    if adjacent_files[0] is not None:
-                        navigation = navigation + element % ("back", adjacent_files[0].link, "< Back&nbsp;")
-                        
-                    if adjacent_files[1] is not None:
-                        navigation = navigation + element % ("next", adjacent_files[1].link, "&nbsp;Next >")
-                            
-                    replacement = "<div class='page-nav'>%s</div>" % navigation
-
-                elif tag == "@@DATE":
-                    if match.group(3):
-                        # We've been given a date format. Strip the double-quotes
-                        date_format = re.sub('"', '', match.group(3))
-                    else:
-                        # There's no date format, so use the default
-                        date_format = "%d %B %Y"
-                    replacement = datetime.datetime.now().strftime(date_format)
-                    
-                elif match.group(3):
-                    # Strip off the double-quotes
-                    replacement = re.sub('"', '', match.group(3))
-
-                    # Handle system-defined tags
-                    if tag == "@@TITLE":
-                        if replacement == "":
-                            replacement = self.title
-
-                # Store the tag name and the replacement as a tuple
-                if replacement is not "":
-                    user_tags.append((tag, replacement))
-
-                    # Remove the tag declaration
-                    if tag in system_tags:
-                        self.output[i] = re.sub(pattern, tag, self.output[i])                    
-                    else:
-                        self.output[i] = re.sub(pattern, "", self.output[i])
-
-        found_title = False
+            if "@@" in self.output[i]:
+                self.output[i] = TAG_PATTERN.sub(declare, self.output[i])
+
+        # Any values supplied by the caller (see render_pages) are used for
+        # the tags which were not declared, and if no title was declared,
+        # the default title is used
+        for tag, value in self.tags.iteritems():
+            user_tags.setdefault(tag, value)
+        user_tags.setdefault("@@TITLE", self.title)
+
+        # Replace all the occurrences of the tags.
+        pattern = self.tag_pattern(user_tags)
+        replace = lambda match: user_tags[match.group(0)]
         for i in range(0, len(self.output)):
-            # Find meta-data tag declarations, in the format:
-            #
-            #    <TAG>:<REPLACEMENT_CONTENTS>
-            #
-            # Remove the declaration tag, and replace all other occurrences
-            # of the tag with the replacement contents.
-            for match in user_tags:
-                target  = match[0]
-                replace = match[1].strip()
-                if (target == "@@TITLE"):
-                    found_title = True
-                if re.search(target, self.output[i]):
-                    # Replace any occurrences of the tag
-                    self.output[i] = re.sub(target, replace, self.output[i])
+            if "@@" in self.output[i]:
+                self.output[i] = pattern.sub(replace, self.output[i])
+
+    def tag_pattern(self, tags):
+        """
+        Returns a compiled pattern which matches any of the given tag names.
+        The longest names are matched first, so that a tag is never
+        mistaken for another tag whose name is a prefix of it. The patterns
+        are cached, as most pages share the same set of tags.
+        """
+        names = tuple(sorted(tags, key = lambda name: (-len(name), name)))
+        pattern = self.tag_patterns.get(names)
+        if pattern is None:
+            if len(self.tag_patterns) >= TAG_PATTERN_CACHE_SIZE:
+                self.tag_patterns.clear()
+            pattern = re.compile("|".join(re.escape(name) for name in names))
+            self.tag_patterns[names] = pattern
+        return pattern
+
+    def formatted_date(self, date_format):
+        """
+        Returns the date of the build in the given format. Every @@DATE tag
+        in the build uses the same date, which is only formatted once for
+        each format.
+        """
+        date = self.dates.get(date_format)
+        if date is None:
+            date = self.build_time.strftime(date_format)
+            self.dates[date_format] = date
+        return date
+
+    def page_navigation(self, source_file):
+        """
+        Returns the 'back' and 'next' links for the page-navigation element
+        of the given file.
+        """
+        navigation = ""
+        element = "<a class='page-nav page-%s' href='%s'>%s</a>"
+        
+        adjacent_files = self.pages.adjacent_files(source_file)
+
+        # The links are relative to the directory of this page
+        directory = posixpath.dirname(self.pages.relative_target(source_file).replace(os.sep, "/"))
+        links = [self.relative_link(self.pages.link(page), directory) if page is not None else "" for page in adjacent_files]
+        
+        if adjacent_files[0] is not None:
+            navigation = navigation + element % ("back", links[0], "< Back&nbsp;")
             
-            if not found_title:
-                if re.search("@@TITLE", self.output[i]):
-                    # Replace any occurrences of the tag
-                    self.output[i] = re.sub("@@TITLE", self.title, self.output[i])
+        if adjacent_files[1] is not None:
+            navigation = navigation + element % ("next", links[1], "&nbsp;Next >")
+                
+        return "<div class='page-nav'>%s</div>" % navigation
                 
     def apply_markup(self):
         """
@@ -524,9 +2531,25 @@ class Kiwi():
         convert it into HTML format. The lines to be processed are
         expected to be in self.input, which will be replaced by
         the formatted lines.
+
+        If there is a markup cache, the lines are taken from the cache
+        instead if the same source has been converted before.
         """
-        self.marker.execute(self.input)
-        self.input = self.marker.output
+        if not self.input:
+            # An empty page has no markup (KiwiMarkup does not accept one)
+            self.input = []
+            return
+        if self.markup_cache is None:
+            self.marker.execute(self.input)
+            self.input = self.marker.output
+            return
+        key = self.markup_cache.key(self.input)
+        lines = self.markup_cache.get(key)
+        if lines is None:
+            self.marker.execute(self.input)
+            lines = self.marker.output
+            self.markup_cache.put(key, lines)
+        self.input = lines
 
     def apply_template(self):
         """
@@ -534,56 +2557,256 @@ class Kiwi():
         for a @@CONTENTS marker in the template, and replaces this with the
         processed lines.
         """
-        template_lines = [re.sub("\n", "", line) for line in self.template.split("\n")]
-        self.output = []
-        for line in template_lines:
-            if line.strip().upper() == "@@CONTENTS":
-                self.output.extend(self.input)
-            else:
-                self.output.append(line)
+        self.output = self.template.apply(self.input)
+
+    def minify_output(self):
+        """
+        Minifies the final HTML lines in self.output (see KiwiMinifier).
+        """
+        self.output = list(self.minifier.minify(self.output))
+
+    def relative_link(self, link, directory):
+        """
+        Returns the link (which is relative to the target path) as a link
+        relative to the given sub-directory of the target path.
+        """
+        if not link or not directory:
+            return link
+        return posixpath.relpath(link, directory)
 
     def write_page(self, source_file):
         """
-        Writes the final HTML page to the target folder.
+        Writes the final HTML page (from self.output) to the target folder.
+        Returns True if the target file was changed (see write_output).
         """
-        target_file = self.target_filename(source_file)
+        return self.write_output(self.target_filename(source_file), "\n".join(self.output))
 
+    def write_output(self, target_file, output):
         """
-        ### BUG: Temporary fix for a problem where occasional files would
-                 fail to be written, claiming to find an invalid character.
-                 Writing such files line-by-line instead seems to fix the
-                 problem. Needs further investigation!
-                 
-                 UPDATE: This appears to be triggered by loading a .kiwi
-                 file, which json.loads() imports as Unicode. I don't know
-                 why this causes writing the pages to occasionally fail,
-                 but I've currently fixed it by converting the imported
-                 Unicode to utf-8 (see self.to_utf8).
+        Writes the output to the target file. If the target file already
+        exists with exactly the same contents it is left untouched, so that
+        its modification time does not change. Returns True if the target
+        file was changed.
+
+        If the compress option was given, the compressed copies of the file
+        are written as well, but only if the file changed, or if they do
+        not exist yet. They are handed to self.compressor, if it has been
+        started, otherwise they are written here.
+
+        This is also called from the writer threads of pipelined builds,
+        so it must not use any of the details of the current page.
         """
-        f = open(target_file, 'w')
+        target_dir = os.path.dirname(target_file)
+        if not os.path.isdir(target_dir):
+            try:
+                os.makedirs(target_dir)
+            except OSError:
+                # Another writer thread may have just created it
+                if not os.path.isdir(target_dir):
+                    raise
 
-        output = "\n".join(self.output)
+        """
+        ### BUG: Occasional files used to fail to be written, claiming to
+                 find an invalid character. This appears to be triggered by
+                 loading a .kiwi file, which json.loads() imports as Unicode,
+                 and is mostly fixed by converting the imported Unicode to
+                 utf-8 (see self.to_utf8), but make sure that the output is
+                 utf-8 anyway.
+        """
+        if isinstance(output, unicode):
+            output = output.encode("utf-8")
+
+        if self.is_unchanged(target_file, output):
+            changed = False
+        else:
+            self.replace_file(target_file, output)
+            changed = True
+
+        if self.params.get("--compress"):
+            for extension, compress in compressors():
+                if changed or not os.path.exists(target_file + extension):
+                    if self.compressor is not None:
+                        self.compressor.add(target_file + extension, compress, output)
+                    else:
+                        self.replace_file(target_file + extension, compress(output))
+        return changed
+
+    def replace_file(self, filename, data):
+        """
+        Writes the data to a temporary file which then replaces the file, so
+        that the file is never left partly written.
+        """
+        temp_file = temp_filename(os.path.dirname(filename))
+        f = os.fdopen(os.open(temp_file, TEMP_FILE_FLAGS, 0666), "wb")
         try:
-            f.write(output)
-        except Exception, e:
-            for line in self.output:
-                f.write(line + "\n")
-                
-        f.close()
+            f.write(data)
+            f.close()
+            if os.name == "nt" and os.path.exists(filename):
+                # Windows cannot rename over an existing file
+                os.remove(filename)
+            os.rename(temp_file, filename)
+        except:
+            f.close()
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
 
-    def target_filename(self, source_file):
-        # Extract the filename from the complete source path
-        path, filename = os.path.split(source_file)
-        
-        # Remove the extension from the filename
-        filename, ext = os.path.splitext(filename)
+    def is_unchanged(self, target_file, output):
+        """
+        Returns True if the target file already exists and contains exactly
+        the given output. The sizes are compared first, so that the file
+        only has to be read if it is the same size.
+        """
+        try:
+            if os.path.getsize(target_file) != len(output):
+                return False
+            f = open(target_file, "rb")
+            try:
+                return f.read() == output
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return False
 
+    def target_filename(self, source_file):
         # Construct the full target path
-        return os.path.join(self.target_path, filename + ".html")
+        return self.pages.target_filename(source_file)
         
-if (__name__ == "__main__"):
-    params = docopt(__doc__, version='Kiwi, version 0.0.33')
-    # print params
-    
+def render(text, template = None, tags = None, title = ""):
+    """
+    Converts a single page of text to HTML in memory, and returns it. See
+    Kiwi.render_pages() for the details of the arguments.
+    """
+    return Kiwi().render_pages([("page.txt", text)], template, tags, title)[0][1]
+
+def render_pages(sources, template = None, tags = None, title = "", sort = None):
+    """
+    Converts a set of pages, given as (name, text) tuples, to HTML in memory,
+    and returns a list of (name, html) tuples. See Kiwi.render_pages().
+    """
+    return Kiwi().render_pages(sources, template, tags, title, sort)
+
+# The Kiwi instance used by each worker process for parallel builds
+worker = None
+
+def init_worker(state):
+    """
+    Initialises a worker process for parallel builds, creating a Kiwi
+    instance from the details supplied by Kiwi.worker_state().
+    """
+    global worker
+    worker = Kiwi()
+    worker.params = state["params"]
+    worker.prepare_highlighter()
+    worker.verbose = state["verbose"]
+    worker.template = state["template"]
+    worker.title = state["title"]
+    worker.build_time = state["build_time"]
+    worker.source_path = state["source_path"]
+    worker.target_path = state["target_path"]
+    worker.manifest = state["manifest"]
+    worker.markup_cache = state["markup_cache"]
+    if state["profile"]:
+        worker.profile = KiwiProfile()
+    worker.pages = KiwiPageList()
+    worker.pages.target_path = state["target_path"]
+    worker.pages.source_root = state["source_root"]
+    worker.pages.files = state["files"]
+    worker.pages.index_files()
+
+def process_page_worker(index):
+    """
+    Converts the page at the given position in the page list, in a worker
+    process. See Kiwi.process_pages_in_parallel(). Returns the result from
+    Kiwi.process_page(), the timings for the page, if the build is being
+    profiled, and the markup cache counts for the page, if any.
+    """
+    if worker.profile is not None:
+        worker.profile = KiwiProfile()
+    if worker.markup_cache is not None:
+        worker.markup_cache.reset_counts()
+    result = worker.process_page(worker.pages.files[index])
+    counts = worker.markup_cache.counts() if worker.markup_cache else None
+    return (result, worker.profile, counts)
+
+def parse_arguments(argv):
+    """
+    Parses the command-line arguments, returning the same dictionary as
+    docopt would. Plain builds, which only use the options in FAST_OPTIONS,
+    are parsed directly, as docopt takes longer to import and to parse the
+    usage text than a small build takes to run. Everything else (including
+    errors, --help and --version) is left to docopt.
+    """
+    params = fast_parse_arguments(argv)
+    if params is None:
+        from docopt import docopt
+        params = docopt(__doc__, argv = argv, version = VERSION)
+    return params
+
+def fast_parse_arguments(argv):
+    """
+    Returns the parameters for the arguments, or None if they need to be
+    parsed by docopt.
+    """
+    if "--" in argv:
+        return None
+    params = dict(DEFAULT_PARAMS)
+    seen = set()
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument.startswith("--"):
+            name, equals, value = argument.partition("=")
+            if name not in FAST_OPTIONS:
+                return None
+            key, takes_value = FAST_OPTIONS[name]
+            if takes_value and not equals:
+                value = next(arguments, None)
+                if value is None:
+                    return None
+            elif equals and not takes_value:
+                return None
+            options = [(key, value if takes_value else True)]
+        elif argument.startswith("-") and argument != "-":
+            # Short options can be combined (-vc), and the last one can
+            # take a value, either in the same argument or the next one
+            options = []
+            for pos in range(1, len(argument)):
+                if "-" + argument[pos] not in FAST_OPTIONS:
+                    return None
+                key, takes_value = FAST_OPTIONS["-" + argument[pos]]
+                if takes_value:
+                    value = argument[pos + 1:] or next(arguments, None)
+                    if value is None:
+                        return None
+                    options.append((key, value))
+                    break
+                options.append((key, True))
+        elif argument != "serve":
+            options = [("SOURCE", argument)]
+        else:
+            return None
+        for key, value in options:
+            if key in seen:
+                return None
+            seen.add(key)
+            params[key] = value
+    if params["--sortbyfile"] and params["--sortbytitle"]:
+        return None
+    if params["--jobs"] is not None and params["--pipeline"]:
+        return None
+    return params
+
+def main(argv = None):
+    """
+    Runs Kiwi with the given command-line arguments (sys.argv by default).
+    This is the entry point for the kiwi command.
+    """
+    params = parse_arguments(sys.argv[1:] if argv is None else argv)
     api = Kiwi()
-    api.execute(params)
+    if params["serve"]:
+        api.serve(params)
+    else:
+        api.execute(params)
+
+if (__name__ == "__main__"):
+    main()
@@ -8,18 +8,29 @@ which it converts to the equivalent HTML format.
 
 Because this is the first part of a larger system it is not really
 intended to be run stand-alone, but see the "if __name___..." section
-at the end of the script for simple command-line use.
+at the end of the script for simple command-line use. When run directly
+it acts as a filter, converting a file (or stdin) and writing the HTML to
+stdout as it goes.
 
 See README.md for more details
 """
 
 import sys
 import re
-import cgi
+import itertools
+import hashlib
 
 KIWI_MODE_STD = 0
 KIWI_MODE_ORG = 1
 
+# Default maximum number of lines to keep in the inline markup cache (see
+# KiwiMarkup.applyInlineMarkup). When the cache is full it is emptied.
+INLINE_CACHE_SIZE = 4096
+
+# Maximum number of highlighted code blocks to keep in the cache (see
+# KiwiHighlighter). When the cache is full it is emptied.
+HIGHLIGHT_CACHE_SIZE = 1024
+
 # Regex definitions ("Now you have two problems...")
 
 # Regex for SETEXT style headers, starting (after up to three
@@ -94,30 +105,311 @@ CODEBLOCK_START_REGEX = r"^[\s]*code:([^\s]*)[\s]*$"
 # own.
 CODEBLOCK_END_REGEX = r"^[\s]*:code[\s]*$"
 
+# Regexes for the 'underline' style of headers, where the line following
+# the header text is a row of '=' (level 1) or '-' (level 2) characters.
+H1_UNDERLINE_REGEX = r"^={5,}=+$"
+H2_UNDERLINE_REGEX = r"^-{5,}-+$"
+
+# HORIZONTAL_LINE_REGEX matches a row of at least six '-' characters
+HORIZONTAL_LINE_REGEX = r"^[-]{5}[-]+$"
+
+# ORG_MODE_REGEX identifies an org-mode file from its first line
+ORG_MODE_REGEX = r"-*- mode: org -*-"
+
+# All the regexes are compiled once, when the module is loaded
+ORG_MODE_PATTERN = re.compile(ORG_MODE_REGEX)
+BOLD_START_PATTERN = re.compile(BOLD_START_REGEX)
+BOLD_END_PATTERN = re.compile(BOLD_END_REGEX)
+EMPH_START_PATTERN = re.compile(EMPH_START_REGEX)
+EMPH_END_PATTERN = re.compile(EMPH_END_REGEX)
+MD_URL_PATTERN = re.compile(MD_URL_REGEX)
+ORG_URL_PATTERN = re.compile(ORG_URL_REGEX)
+MD_IMG_PATTERN = re.compile(MD_IMG_REGEX)
+IMG_PATTERN = re.compile(IMG_REGEX)
+AUDIO_PATTERN = re.compile(AUDIO_REGEX)
+LINK_PATTERN = re.compile(LINK_REGEX)
+FOOTNOTE_PATTERN = re.compile(FOOTNOTE_REGEX)
+FOOTNOTE_TARGET_PATTERN = re.compile(FOOTNOTE_TARGET_REGEX)
+HEADER_PATTERN = re.compile(HEADER_REGEX)
+ORG_HEADER_PATTERN = re.compile(ORG_HEADER_REGEX)
+LIST_PATTERN = re.compile(LIST_REGEX)
+TABLE_HEADER_PATTERN = re.compile(TABLE_HEADER_REGEX)
+CODEBLOCK_START_PATTERN = re.compile(CODEBLOCK_START_REGEX)
+CODEBLOCK_END_PATTERN = re.compile(CODEBLOCK_END_REGEX)
+H1_UNDERLINE_PATTERN = re.compile(H1_UNDERLINE_REGEX)
+H2_UNDERLINE_PATTERN = re.compile(H2_UNDERLINE_REGEX)
+HORIZONTAL_LINE_PATTERN = re.compile(HORIZONTAL_LINE_REGEX)
+
+def escape(text, quote = False):
+    """
+    Replaces &, < and > (and " if quote is True) with HTML entities, exactly
+    as cgi.escape does, without the cost of importing the cgi module.
+    """
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if quote:
+        text = text.replace('"', "&quot;")
+    return text
+
+# Replacement functions for the IMG, AUDIO and LINK regexes. These are used
+# instead of replacement strings because the optional groups in these regexes
+# can be unmatched, and re.sub cannot substitute unmatched groups (see
+# http://bugs.python.org/issue1519638), so they are replaced by empty strings.
+def imgReplacement(match):
+    return "<img src='%s' class='%s' alt='%s' title='%s'/>" % (
+        match.group(7), match.group(3) or "", match.group(6) or "", match.group(6) or "")
+
+def audioReplacement(match):
+    return "<audio width='300px' height='32px' src='%s' class='%s' controls='controls'> Your browser does not support audio playback. </audio>" % (
+        match.group(7), match.group(3) or "")
+
+def linkReplacement(match):
+    return "<a href='%s' class='%s' alt='%s'>%s</a>" % (
+        match.group(7), match.group(3) or "", match.group(6) or "", match.group(6) or "")
+
+# Rules for the built-in syntax highlighter (see KiwiHighlighter). Each
+# language has a list of (class, regex) pairs, which are tried in order. The
+# classes are the ones used by Pygments, so that the same style sheets can be
+# used whether or not Pygments is installed.
+def keywords(words):
+    return r"\b(?:%s)\b" % "|".join(words.split())
+
+NUMBER_RULE = ("m", r"\b(?:0[xX][0-9a-fA-F]+|[0-9]+(?:\.[0-9]*)?(?:[eE][-+]?[0-9]+)?)[lLuUfFjJ]*\b")
+STRING_RULE = ("s", r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'')
+C_COMMENT_RULE = ("c", r"//[^\n]*|/\*[\s\S]*?\*/")
+
+HIGHLIGHT_RULES = {
+    "python": [
+        ("c", r"#[^\n]*"),
+        ("s", r'[rRuUbB]{0,2}(?:"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\')'),
+        STRING_RULE,
+        NUMBER_RULE,
+        ("k", keywords("and as assert break class continue def del elif else except exec finally for from "
+                       "global if import in is lambda nonlocal not or pass print raise return try while with yield "
+                       "None True False")),
+        ("nb", keywords("abs all any dict enumerate float getattr hasattr int isinstance len list map max min "
+                        "object open range repr set sorted str sum super tuple type unicode zip self")),
+    ],
+    "javascript": [
+        C_COMMENT_RULE,
+        ("s", r"`(?:\\.|[^`\\])*`"),
+        STRING_RULE,
+        NUMBER_RULE,
+        ("k", keywords("async await break case catch class const continue debugger default delete do else "
+                       "export extends finally for function if import in instanceof let new of return super "
+                       "switch this throw try typeof var void while with yield null undefined true false")),
+    ],
+    "c": [
+        C_COMMENT_RULE,
+        ("cp", r"^[ \t]*#[^\n]*"),
+        STRING_RULE,
+        NUMBER_RULE,
+        ("k", keywords("abstract auto bool boolean break byte case catch char class const continue default "
+                       "delete do double else enum extends extern final finally float for goto if implements "
+                       "import inline int interface long namespace new package private protected public "
+                       "register return short signed sizeof static struct super switch template this throw "
+                       "throws try typedef union unsigned using virtual void volatile while null NULL true false")),
+    ],
+    "shell": [
+        ("c", r"(?:^|(?<=\s))#[^\n]*"),
+        STRING_RULE,
+        ("nv", r"\$\{[^}\n]*\}|\$[a-zA-Z_0-9@#?*!$-]+"),
+        ("k", keywords("case do done elif else esac export fi for function if in local return select then "
+                       "until while")),
+    ],
+    "sql": [
+        ("c", r"--[^\n]*|/\*[\s\S]*?\*/"),
+        STRING_RULE,
+        NUMBER_RULE,
+        ("k", r"(?i)\b(?:add|all|alter|and|as|asc|between|by|case|create|delete|desc|distinct|drop|else|end|"
+              r"exists|from|group|having|in|index|inner|insert|into|is|join|key|left|like|limit|not|null|on|"
+              r"or|order|outer|primary|right|select|set|table|then|union|update|values|view|when|where)\b"),
+    ],
+}
+
+HIGHLIGHT_ALIASES = {
+    "py": "python", "python2": "python", "python3": "python",
+    "js": "javascript", "json": "javascript",
+    "cpp": "c", "c++": "c", "h": "c", "java": "c", "cs": "c", "csharp": "c",
+    "sh": "shell", "bash": "shell", "console": "shell",
+}
+
+# Pygments is only imported when it is first needed (see load_pygments)
+pygments = None
+
+def load_pygments():
+    """
+    Imports Pygments if it is installed, returning True if it is available.
+    """
+    global pygments
+    if pygments is None:
+        try:
+            import pygments.lexers
+            import pygments.formatters
+            import pygments.util
+        except ImportError:
+            pygments = False
+    return pygments is not False
+
+class KiwiHighlighter:
+    """
+    Class to apply syntax highlighting to blocks of code, marking the parts
+    of the code with <span> tags. Pygments is used if it is installed (and
+    usePygments is True), otherwise a simple built-in tokenizer is used,
+    which knows a few common languages (see HIGHLIGHT_RULES).
+
+    As the same code is often repeated, the highlighted blocks are cached,
+    keyed by the language and the hash of the code, for up to cacheSize
+    blocks. The hits and misses counters record how well the cache is
+    working.
+    """
+    def __init__(self, usePygments = True, cacheSize = HIGHLIGHT_CACHE_SIZE):
+        self.usePygments = usePygments and load_pygments()
+        self.cacheSize = cacheSize
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.lexers = {}
+        self.patterns = {}
+
+    def version(self):
+        """
+        Returns a description of the highlighter, which identifies the
+        output it produces.
+        """
+        if self.usePygments:
+            return "pygments-%s" % pygments.__version__
+        return "builtin"
+
+    def supports(self, language):
+        """
+        Returns True if the language can be highlighted.
+        """
+        if self.usePygments:
+            return self.lexer(language) is not None
+        return self.builtinLanguage(language) is not None
+
+    def highlight(self, language, lines):
+        """
+        Returns the highlighted version of the given lines of code, as a
+        list of lines of HTML.
+        """
+        if not lines:
+            return []
+        text = "\n".join(lines)
+        key = (language, hashlib.md5(text).digest())
+        result = self.cache.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        if self.usePygments:
+            # Pygments returns Unicode, but the other lines of the page are
+            # utf-8, and the two cannot be joined if the page is not ASCII
+            html = pygments.highlight(text, self.lexer(language), pygments.formatters.HtmlFormatter(nowrap = True)).encode("utf-8")
+            if html.endswith("\n"):
+                html = html[:-1]
+        else:
+            html = self.tokenize(self.builtinLanguage(language), text)
+        result = html.split("\n")
+        if self.cacheSize:
+            if len(self.cache) >= self.cacheSize:
+                self.cache.clear()
+            self.cache[key] = result
+        return result
+
+    def lexer(self, language):
+        """
+        Returns the Pygments lexer for the language, or None if there is no
+        such lexer.
+        """
+        if language not in self.lexers:
+            try:
+                self.lexers[language] = pygments.lexers.get_lexer_by_name(language, stripnl = False, ensurenl = False, encoding = "utf-8")
+            except pygments.util.ClassNotFound:
+                self.lexers[language] = None
+        return self.lexers[language]
+
+    def builtinLanguage(self, language):
+        """
+        Returns the name of the built-in rules for the language, or None if
+        there are none.
+        """
+        language = language.lower()
+        language = HIGHLIGHT_ALIASES.get(language, language)
+        if language in HIGHLIGHT_RULES:
+            return language
+        return None
+
+    def tokenize(self, language, text):
+        """
+        Returns the text as HTML, highlighted using the built-in rules for
+        the language.
+        """
+        pattern = self.patterns.get(language)
+        if pattern is None:
+            rules = HIGHLIGHT_RULES[language]
+            pattern = re.compile("|".join("(?P<t%d>%s)" % (i, regex) for i, (cls, regex) in enumerate(rules)), re.MULTILINE)
+            self.patterns[language] = pattern
+        classes = [cls for cls, regex in HIGHLIGHT_RULES[language]]
+        output = []
+        pos = 0
+        for match in pattern.finditer(text):
+            output.append(escape(text[pos:match.start()]))
+            cls = classes[int(match.lastgroup[1:])]
+            # Spans are not carried over line breaks, so that each line of
+            # the output is complete in itself
+            for i, part in enumerate(match.group(0).split("\n")):
+                if i:
+                    output.append("\n")
+                if part:
+                    output.append("<span class=\"%s\">%s</span>" % (cls, escape(part)))
+            pos = match.end()
+        output.append(escape(text[pos:]))
+        return "".join(output)
+
 class KiwiMarkup:
     """
     Main processing class. Call the execute() method to process a list of
     text lines. On return, the KiwiMarkup.output variable will hold a list
-    of lines in HTML format. Note that this is an HTML fragment, and does
+    of lines in HTML format. Alternatively, the stream() method yields the
+    HTML lines from any iterable of text lines as they are produced. Note that this is an HTML fragment, and does
     not include any framing <HTML> and <BODY> tags -- it is assumed that
     the calling program will take the output and insert it into an appropriate
     template.
+
+    The results of applying the inline markup are cached (for up to
+    inlineCacheSize lines, or not at all if this is 0), as the same lines
+    and table cells are often repeated, both within a document and across
+    documents. The inlineHits and inlineMisses counters record how well
+    the cache is working.
+
+    If a KiwiHighlighter instance is given, code blocks which name their
+    language (code:LANGUAGE) are highlighted with it, if it supports the
+    language.
     """
 
-    def __init__(self):
+    def __init__(self, inlineCacheSize = INLINE_CACHE_SIZE, highlighter = None):
+        self.highlighter = highlighter
+        self.codeLanguage = ""
+        self.codeLines = []
+        self.inlineCacheSize = inlineCacheSize
+        self.inlineCache = {}
+        self.inlineHits = 0
+        self.inlineMisses = 0
         self.state  = KiwiState()
-        self.boldStartPattern = re.compile(BOLD_START_REGEX)
-        self.boldEndPattern = re.compile(BOLD_END_REGEX)
-        self.emphStartPattern = re.compile(EMPH_START_REGEX)
-        self.emphEndPattern = re.compile(EMPH_END_REGEX)
-        self.mdUrlPattern = re.compile(MD_URL_REGEX)
-        self.orgmodeUrlPattern = re.compile(ORG_URL_REGEX)
-        self.mdImgPattern = re.compile(MD_IMG_REGEX)
-        self.imgPattern = re.compile(IMG_REGEX)
-        self.audioPattern = re.compile(AUDIO_REGEX)
-        self.linkPattern = re.compile(LINK_REGEX)
-        self.footnotePattern = re.compile(FOOTNOTE_REGEX)
-        self.footnoteTargetPattern = re.compile(FOOTNOTE_TARGET_REGEX)
+        self.line = KiwiLineScanner(KIWI_MODE_STD)
+        self.boldStartPattern = BOLD_START_PATTERN
+        self.boldEndPattern = BOLD_END_PATTERN
+        self.emphStartPattern = EMPH_START_PATTERN
+        self.emphEndPattern = EMPH_END_PATTERN
+        self.mdUrlPattern = MD_URL_PATTERN
+        self.orgmodeUrlPattern = ORG_URL_PATTERN
+        self.mdImgPattern = MD_IMG_PATTERN
+        self.imgPattern = IMG_PATTERN
+        self.audioPattern = AUDIO_PATTERN
+        self.linkPattern = LINK_PATTERN
+        self.footnotePattern = FOOTNOTE_PATTERN
+        self.footnoteTargetPattern = FOOTNOTE_TARGET_PATTERN
 
     def execute(self, lines, mode = None):
         """
@@ -127,24 +419,44 @@ class KiwiMarkup:
         default is KIWI_MODE_STD.
         """
         assert (lines), "No lines provided for processing"
+        self.output = list(self.stream(lines, mode))
+        return len(self.output) > 0
+
+    def stream(self, lines, mode = None):
+        """
+        Generator version of execute(). The lines parameter can be any
+        iterable of plain text lines (including an open file), and the
+        HTML lines are yielded as soon as they have been produced, so the
+        amount of memory used does not depend on the size of the input.
+        """
+        lines = iter(lines)
+        firstLine = next(lines, None)
+        if firstLine is None:
+            return
+
         if (mode == None):
             mode = KIWI_MODE_STD
-            if len(lines) > 0:
-                # Check the first line to see if this is an
-                # org-mode file, and if it is, override the
-                # mode.
-                if re.search("-*- mode: org -*-", lines[0]):
-                    mode = KIWI_MODE_ORG
-
+            # Check the first line to see if this is an
+            # org-mode file, and if it is, override the
+            # mode.
+            if ORG_MODE_PATTERN.search(firstLine):
+                mode = KIWI_MODE_ORG
+
+        # The same instance can be used for any number of documents, so
+        # clear anything left over from the previous one
         self.mode = mode
-        self.line = KiwiLineScanner(self.mode)
+        self.state.reset()
+        self.line.mode = mode
+        self.line.reset()
         self.thisLine = None
         self.nextLine = None
         self.indents = []
         self.output = []
+        self.codeLanguage = ""
+        self.codeLines = []
 
         # Process the lines
-        for line in lines:
+        for line in itertools.chain([firstLine], lines):
             # The processing often needs to know the contents of the next
             # line, so we read one line ahead. Therefore thisLine is
             # actually the line we read previously (and will be None on the
@@ -152,7 +464,7 @@ class KiwiMarkup:
             self.thisLine = self.nextLine
 
             # Convert tabs to spaces
-            self.nextLine = re.sub("\t", "    ", line.rstrip())
+            self.nextLine = line.rstrip().replace("\t", "    ")
 
             if not self.line.skipNextLine:
                 self.processLine()
@@ -160,6 +472,13 @@ class KiwiMarkup:
                 # Never skip more than one line
                 self.line.skipNextLine = False
 
+            # Output lines are never altered once they have been added,
+            # so they can be passed on straight away
+            if self.output:
+                for outputLine in self.output:
+                    yield outputLine
+                self.output = []
+
         # Process the final line
         if not self.line.skipNextLine:
             self.thisLine = self.nextLine
@@ -167,8 +486,11 @@ class KiwiMarkup:
             self.processLine()
 
         self.endAllSections()
+        self.flushCodeLines()
 
-        return len(self.output) > 0
+        for outputLine in self.output:
+            yield outputLine
+        self.output = []
 
     def startParagraph(self):
         """
@@ -319,14 +641,32 @@ class KiwiMarkup:
         """
         if not self.state.inCodeSection:
             self.output.append('<pre>')
-            self.output.append('<code>')
+            language = self.line.codeLanguage
+            if self.highlighter and language and self.highlighter.supports(language):
+                # The lines are kept until the end of the block, and are
+                # then highlighted all together
+                self.codeLanguage = language
+                self.output.append("<code class='language-%s'>" % escape(language, True))
+            else:
+                self.output.append('<code>')
             self.state.inCodeSection = True
 
+    def flushCodeLines(self):
+        """
+        Outputs the highlighted lines for the current block of code, if it
+        is being highlighted.
+        """
+        if self.codeLanguage:
+            self.output.extend(self.highlighter.highlight(self.codeLanguage, self.codeLines))
+            self.codeLanguage = ""
+            self.codeLines = []
+
     def endCodeSection(self):
         """
         Ends a block of code
         """
         if self.state.inCodeSection:
+            self.flushCodeLines()
             self.output.append('</code>')
             self.output.append('</pre>')
             self.state.inCodeSection = False
@@ -356,63 +696,76 @@ class KiwiMarkup:
         """
         Extracts any attributes from a line containing img markup
         """
-        attributes = re.search(IMG_REGEX, line)
+        attributes = IMG_PATTERN.search(line)
         if (attributes):
             return (attributes.group(1)[1:], attributes.group(3)[1:])
         else:
             return None
 
-    def re_sub(self, pattern, replacement, string):
+    def applyInlineMarkup(self, line):
         """
-        Work-around for re.sub unmatched group error.
-
-        Note that an alternative would be to use the regex package, but this
-        is not a default part of the Python library, and I want to avoid
-        external dependencies if at all possible.
+        Applies markup to the supplied line and returns the results.
 
-        See https://gist.github.com/gromgull/3922244
+        Every piece of inline markup needs at least one '*', '_' or '['
+        character, so lines without any of these (which is most plain
+        text) are returned straight away. Otherwise the result is taken
+        from the inline cache if the same line has been seen before.
         """
-        def _r(m):
-            # Now this is ugly.
-            # Python has a "feature" where unmatched groups return None
-            # then re.sub chokes on this.
-            # see http://bugs.python.org/issue1519638
-
-            # this works around and hooks into the internal of the re module...
-
-            # the match object is replaced with a wrapper that
-            # returns "" instead of None for unmatched groups
-
-            class _m():
-                def __init__(self, m):
-                    self.m=m
-                    self.string=m.string
-                def group(self, n):
-                    return m.group(n) or ""
-
-            return re._expand(pattern, _m(m), replacement)
-
-        return re.sub(pattern, _r, string)
-
-    def applyInlineMarkup(self, line):
+        if "*" not in line and "_" not in line and "[" not in line:
+            return line
+        result = self.inlineCache.get(line)
+        if result is not None:
+            self.inlineHits += 1
+            return result
+        self.inlineMisses += 1
+        result = self.applyInlinePatterns(line)
+        if self.inlineCacheSize:
+            if len(self.inlineCache) >= self.inlineCacheSize:
+                self.inlineCache.clear()
+            self.inlineCache[line] = result
+        return result
+
+    def applyInlinePatterns(self, line):
+        """
+        Applies the inline markup patterns to the supplied line. Each
+        substitution is only attempted if the literal text which it
+        requires is present.
         """
-        Applies markup to the supplied line and returns the results. It
-        assumes the self.line holds the additional details for the line.
-        """
-        line = self.boldStartPattern.sub(r"\1<b>\3", line)
-        line = self.boldEndPattern.sub(r"\1</b>\3", line)
-        line = self.emphStartPattern.sub(r"\1<i>\3", line)
-        line = self.emphEndPattern.sub(r"\1</i>\3", line)
-        line = self.mdImgPattern.sub(r"<img src='\2' alt='\1' title='\1'/>", line)
-        line = self.re_sub(self.imgPattern, r"<img src='\7' class='\3' alt='\6' title='\6'/>", line)
-        line = self.re_sub(self.audioPattern, r"<audio width='300px' height='32px' src='\7' class='\3' controls='controls'> Your browser does not support audio playback. </audio>", line)
-        line = self.re_sub(self.linkPattern, r"<a href='\7' class='\3' alt='\6'>\6</a>", line)
-        line = self.mdUrlPattern.sub(r"<a href='\2'>\1</a>", line)
-        line = self.orgmodeUrlPattern.sub(r"<a href='\1'>\2</a>", line)
-        line = self.footnoteTargetPattern.sub(r"\1. <a name='footnote_target_\1' href='#footnote_ref_\1'>&#160;&#8617;</a>", line)
-        line = self.footnotePattern.sub(r"<a name='footnote_ref_\1' href='#footnote_target_\1'>[<sup>\1</sup>]</a>", line)
+        if "**" in line:
+            line = self.boldStartPattern.sub(r"\1<b>\3", line)
+            line = self.boldEndPattern.sub(r"\1</b>\3", line)
+        if "_" in line:
+            line = self.emphStartPattern.sub(r"\1<i>\3", line)
+            line = self.emphEndPattern.sub(r"\1</i>\3", line)
+        if "[" not in line:
+            return line
+        if "![" in line:
+            line = self.mdImgPattern.sub(r"<img src='\2' alt='\1' title='\1'/>", line)
+        if "[img" in line:
+            line = self.imgPattern.sub(imgReplacement, line)
+        if "[audio" in line:
+            line = self.audioPattern.sub(audioReplacement, line)
+        if "[link" in line:
+            line = self.linkPattern.sub(linkReplacement, line)
+        if "](" in line:
+            line = self.mdUrlPattern.sub(r"<a href='\2'>\1</a>", line)
+        if "[[" in line:
+            line = self.orgmodeUrlPattern.sub(r"<a href='\1'>\2</a>", line)
+        if "[^" in line:
+            line = self.footnoteTargetPattern.sub(r"\1. <a name='footnote_target_\1' href='#footnote_ref_\1'>&#160;&#8617;</a>", line)
+            line = self.footnotePattern.sub(r"<a name='footnote_ref_\1' href='#footnote_target_\1'>[<sup>\1</sup>]</a>", line)
         return line
         
+    def inlineHitRate(self):
+        """
+        Returns the fraction of the lines with inline markup which were
+        found in the inline cache.
+        """
+        total = self.inlineHits + self.inlineMisses
+        if total == 0:
+            return 0.0
+        return float(self.inlineHits) / total
+
     def processLine(self):
         """
         Processes the current line, converting it into the appropriate
@@ -489,22 +842,31 @@ class KiwiMarkup:
             if includeLine:
                 if not self.state.inBlock and not self.state.inCodeSection:
                     self.thisLine = self.applyInlineMarkup(self.thisLine)
+                elif self.state.inCodeSection and self.codeLanguage:
+                    # Highlighted at the end of the block
+                    self.codeLines.append(self.thisLine[4:])
+                    return
                 else:
                     self.thisLine = self.thisLine[4:]
-                    self.thisLine = cgi.escape(self.thisLine)
+                    self.thisLine = escape(self.thisLine)
                 self.output.append(self.thisLine)
 
 class KiwiState:
     """
     Simple class to hold the current state of the processor
     """
-    inBold = False
-    inItalic = False
-    inParagraph = False
-    inTable = False
-    inList = False
-    inBlock = False
-    inCodeSection = False
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.inBold = False
+        self.inItalic = False
+        self.inParagraph = False
+        self.inTable = False
+        self.inList = False
+        self.inBlock = False
+        self.inCodeSection = False
+        self.inOrgSection = False
 
 class KiwiLineScanner:
     """
@@ -516,7 +878,7 @@ class KiwiLineScanner:
     isTable = False
     isTableHeader = False
     isBlock = False
-    isBlank = False
+    isBlankLine = False
     isHorizontalLine = False
 
     headerLevel = 0
@@ -530,12 +892,12 @@ class KiwiLineScanner:
     skipNextLine = False
 
     def __init__(self, mode):
-        self.headerPattern = re.compile(HEADER_REGEX)
-        self.orgHeaderPattern = re.compile(ORG_HEADER_REGEX)
-        self.listPattern   = re.compile(LIST_REGEX)
-        self.tableHeaderPattern = re.compile(TABLE_HEADER_REGEX)
-        self.codeStartPattern = re.compile(CODEBLOCK_START_REGEX)
-        self.codeEndPattern = re.compile(CODEBLOCK_END_REGEX)
+        self.headerPattern = HEADER_PATTERN
+        self.orgHeaderPattern = ORG_HEADER_PATTERN
+        self.listPattern   = LIST_PATTERN
+        self.tableHeaderPattern = TABLE_HEADER_PATTERN
+        self.codeStartPattern = CODEBLOCK_START_PATTERN
+        self.codeEndPattern = CODEBLOCK_END_PATTERN
         self.mode = mode
 
     def reset(self):
@@ -546,6 +908,7 @@ class KiwiLineScanner:
         self.isTableHeader = False
         self.isBlankLine = False
         self.isBlock = False
+        self.isHorizontalLine = False
         self.isCodeStart = False
         self.isCodeEnd = False
 
@@ -567,15 +930,21 @@ class KiwiLineScanner:
         Main entry point. This is passed the current and next lines
         in the list, and the KiwiState instance that the main
         processor is using.
+
+        Most of the line types can be identified by the first non-blank
+        character of the line (or of the next line), so the checks are
+        only carried out for the lines which could possibly match them.
         """
         self.state = state
         self.reset()
-        if thisLine.strip() == "":
+        stripped = thisLine.strip()
+        if stripped == "":
             self.isBlankLine = True
             self.isParagraph = False
         else:
-            if (self.mode == KIWI_MODE_ORG) and (thisLine.strip()[0] == "*"):
-                match = re.search(self.orgHeaderPattern, thisLine)
+            first = stripped[0]
+            if (self.mode == KIWI_MODE_ORG) and (first == "*"):
+                match = self.orgHeaderPattern.search(thisLine)
                 if match:
                     elements = match.groups()
                     header = elements[0]
@@ -589,14 +958,21 @@ class KiwiLineScanner:
             self.check_for_header(thisLine, nextLine)
             self.check_for_table(thisLine, nextLine)
             self.check_for_block(thisLine)
-            self.check_for_list(thisLine, nextLine)
-            self.check_for_horizontal_line(thisLine)
-            self.check_for_code_start(thisLine)
-            self.check_for_code_end(thisLine)
+            if first in "-*":
+                self.check_for_list(thisLine, nextLine)
+            if first == "-":
+                self.check_for_horizontal_line(thisLine)
+            if first == "c":
+                self.check_for_code_start(thisLine)
+            elif first == ":":
+                self.check_for_code_end(thisLine)
 
     def check_for_header(self, thisLine, nextLine):
-        # Check for '#' style of header
-        match = re.search(self.headerPattern, thisLine)
+        # Check for '#' style of header, which can only be preceded by
+        # up to three whitespace characters
+        match = None
+        if "#" in thisLine[0:4]:
+            match = self.headerPattern.search(thisLine)
         if match:
             self.isParagraph = False
             self.isHeader = True
@@ -606,13 +982,13 @@ class KiwiLineScanner:
             if (len(elements) > 1):
                 self.headerText = elements[1]
         # Check for 'underline' style of header
-        elif re.search(r"^={5,}=+$", nextLine):
+        elif nextLine[0:1] == "=" and H1_UNDERLINE_PATTERN.search(nextLine):
             self.isParagraph = False
             self.isHeader = True
             self.skipNextLine = True
             self.headerLevel = 1
             self.headerText = thisLine
-        elif re.search(r"^-{5,}-+$", nextLine):
+        elif nextLine[0:1] == "-" and H2_UNDERLINE_PATTERN.search(nextLine):
             self.isParagraph = False
             self.isHeader = True
             self.skipNextLine = True
@@ -620,7 +996,7 @@ class KiwiLineScanner:
             self.headerText = thisLine
 
     def check_for_list(self, thisLine, nextLine):
-        match = re.search(self.listPattern, thisLine)
+        match = self.listPattern.search(thisLine)
         if match and not self.state.inBlock:
             self.isParagraph = False
             self.isList = True
@@ -640,7 +1016,7 @@ class KiwiLineScanner:
             # don't close the LI tag on the current line if
             # it is followed by a sublist -- essentially the
             # sub-list in inside LI tag).
-            match = re.search(self.listPattern, nextLine)
+            match = self.listPattern.search(nextLine)
             if match:
                 self.isNestedList = len(match.groups()[0]) > self.listIndent
 
@@ -656,15 +1032,16 @@ class KiwiLineScanner:
         presence of at least two '|' characters in the line, which will also
         be taken as indicating a table.
         """
-        match = re.search(self.tableHeaderPattern, nextLine)
-        if match:
+        if "---" in nextLine and self.tableHeaderPattern.search(nextLine):
             self.isTable = True
             self.isTableHeader = True
             self.skipNextLine = True
 
-        self.tableColumns = [column.strip() for column in thisLine.split("|")]
-        if (len(self.tableColumns) >= 3) or (len(self.tableColumns) > 0 and self.state.inTable):
-            self.isTable = True
+        # Once a table has been started, every line is part of it
+        if self.isTable or self.state.inTable or thisLine.count("|") >= 2:
+            self.tableColumns = [column.strip() for column in thisLine.split("|")]
+            if (len(self.tableColumns) >= 3) or self.state.inTable:
+                self.isTable = True
 
     def check_for_block(self, thisLine):
         """
@@ -681,31 +1058,35 @@ class KiwiLineScanner:
         it is preceded by at least one blank line) it will be detected here and
         treated as a horizontal line
         """
-        if re.search(r"^[-]{5}[-]+$", thisLine):
+        if HORIZONTAL_LINE_PATTERN.search(thisLine):
             self.isParagraph = False
             self.isHorizontalLine = True
 
     def check_for_code_start(self, thisLine):
-        match = re.search(self.codeStartPattern, thisLine)
+        match = self.codeStartPattern.search(thisLine)
         if match:
             self.isCodeStart = True
             self.codeLanguage = match.group(1)
 
     def check_for_code_end(self, thisLine):
-        match = re.search(self.codeEndPattern, thisLine)
+        match = self.codeEndPattern.search(thisLine)
         if match:
             self.isCodeEnd = True
             self.codeLanguage = ""
 
 if __name__ == "__main__":
 
-    # For testing purposes only. Pass a file name on the command-line,
-    # and it will be converted to an HTML fragment, which will then be
-    # output.
-    if len(sys.argv) > 1:
+    # Pass a file name on the command-line, or pipe the text into stdin,
+    # and it will be converted to an HTML fragment, which is written to
+    # stdout as it is produced.
+    if len(sys.argv) > 1 and sys.argv[1] != "-":
         f = open(sys.argv[1])
-        lines = f.readlines()
+    else:
+        f = sys.stdin
+    kiwi = KiwiMarkup()
+    # Use readline() rather than iterating over the file, to avoid the
+    # read-ahead buffering of file iteration when reading from a pipe
+    for line in kiwi.stream(iter(f.readline, "")):
+        sys.stdout.write(line + "\n")
+    if f is not sys.stdin:
         f.close()
-        kiwi = KiwiMarkup()
-        kiwi.execute(lines)
-        print("\n".join(kiwi.output))
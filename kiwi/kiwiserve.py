@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Kiwi Serve
+
+The request handler for the preview web-server (see Kiwi.serve). It is kept
+in a module of its own so that the web-server modules are only imported when
+the server is started.
+"""
+
+# Standard library imports
+import mimetypes
+import urllib
+import urlparse
+import BaseHTTPServer
+
+class KiwiRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Request handler for the preview web-server. The Kiwi instance which
+    converts the pages is held by the server, as server.kiwi.
+    """
+    def do_GET(self):
+        kiwi = self.server.kiwi
+        path = urllib.unquote(urlparse.urlparse(self.path).path)
+        if path in ("/", "/index.html"):
+            content = kiwi.render_index()
+            content_type = "text/html; charset=utf-8"
+        else:
+            content = kiwi.render_link(path.lstrip("/"))
+            content_type = "text/html; charset=utf-8"
+            if content is None:
+                content = kiwi.read_static_file(path.lstrip("/"))
+                content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content is None:
+            self.send_error(404, "File not found")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.kiwi.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Kiwi Tests
+
+Regression tests for the site generator.
+
+Run with:
+
+    python test_kiwi.py
+"""
+
+# Standard library imports
+import datetime
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+# Application specific imports
+import docopt
+import kiwi
+
+def write_file(path, text):
+    """
+    Writes the text to the file, creating its directory if necessary.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    f = open(path, "w")
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+# Argument lists which parse_arguments() should handle without docopt
+FAST_ARGUMENTS = [
+    [],
+    ["site"],
+    ["-vc", "site"],
+    ["site", "-vcirz"],
+    ["-t", "out", "site"],
+    ["-tout", "site"],
+    ["-vctout", "site"],
+    ["-vct", "out", "site"],
+    ["--target=out", "site"],
+    ["--target", "out", "--template=page.html", "site"],
+    ["-m", "page.html", "-j", "4", "--sortbytitle", "site"],
+    ["-j0", "--minify", "--highlight", "--compress"],
+    ["--pipeline", "--include=*.txt,*.rst", "--exclude", "drafts", "site"],
+    ["--cachedir", ".cache", "--sortbyfile", "-w", "site"],
+    ["--verbose", "--contents", "--incremental", "--watch", "--recursive"],
+]
+
+# Argument lists which the fast path must leave to docopt (or parse the
+# same way), including repeated and conflicting options
+OTHER_ARGUMENTS = [
+    ["-v", "-v", "site"],
+    ["-vv"],
+    ["-t", "a", "--target", "b"],
+    ["--target=a", "-tb"],
+    ["site", "other"],
+    ["--sortbyfile", "--sortbytitle"],
+    ["-j", "2", "--pipeline"],
+    ["--pipeline", "--pipeline"],
+    ["--pipeline=yes"],
+    ["-t"],
+    ["--target"],
+    ["--unknown"],
+    ["-x"],
+    ["--", "-site"],
+    ["-"],
+    ["serve", "site"],
+    ["--cachedir", "c", "--cachesize", "10"],
+    ["-p", "site"],
+]
+
+# Pieces that the random argument lists are built from
+ARGUMENT_PIECES = [
+    ["site"], ["other"], ["-v"], ["-c"], ["-i"], ["-w"], ["-r"], ["-z"], ["-vc"],
+    ["-cz"], ["-rw"], ["-t", "out"], ["-tout"], ["-vtout"], ["--target=out"],
+    ["--target", "out"], ["-m", "t.html"], ["--template=t.html"], ["-j", "2"],
+    ["-j2"], ["--jobs=0"], ["--pipeline"], ["--minify"], ["--highlight"],
+    ["--sortbyfile"], ["--sortbytitle"], ["--include=*.md"], ["--exclude", "x"],
+    ["--cachedir", "c"], ["--verbose"], ["--contents"], ["--incremental"],
+    ["--watch"], ["--recursive"], ["--compress"], ["-p"], ["-x"], ["--"],
+]
+
+class TestParseArguments(unittest.TestCase):
+
+    def docopt(self, argv):
+        """
+        Returns the parameters that docopt gives for the arguments, or None
+        if docopt rejects them.
+        """
+        try:
+            return docopt.docopt(kiwi.__doc__, argv = argv, version = kiwi.VERSION)
+        except SystemExit:
+            return None
+
+    def check(self, argv):
+        params = kiwi.fast_parse_arguments(argv)
+        if params is not None:
+            self.assertEqual(params, self.docopt(argv), argv)
+        return params
+
+    def test_fast_path(self):
+        for argv in FAST_ARGUMENTS:
+            self.assertNotEqual(self.check(argv), None, argv)
+
+    def test_other_arguments(self):
+        for argv in OTHER_ARGUMENTS:
+            self.check(argv)
+
+    def test_random_arguments(self):
+        generator = random.Random(1)
+        for i in range(1000):
+            argv = []
+            for j in range(generator.randint(0, 5)):
+                argv.extend(generator.choice(ARGUMENT_PIECES))
+            self.check(argv)
+
+    def test_default_params(self):
+        self.assertEqual(sorted(kiwi.DEFAULT_PARAMS), sorted(self.docopt([])))
+        self.assertEqual(kiwi.DEFAULT_PARAMS, self.docopt([]))
+
+class TestScanDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.scandir = kiwi.OPTIONAL_MODULES.get("scandir")
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        if self.scandir is None:
+            kiwi.OPTIONAL_MODULES.pop("scandir", None)
+        else:
+            kiwi.OPTIONAL_MODULES["scandir"] = self.scandir
+
+    def scan(self):
+        return kiwi.scan_directory(self.source, ["*.txt"], [], True)
+
+    def scan_both(self):
+        """
+        Returns the file names found by a recursive scan, with and (if it is
+        installed) without the scandir module.
+        """
+        results = []
+        if kiwi.optional_module("scandir") is not None:
+            results.append(sorted(self.scan()))
+        kiwi.OPTIONAL_MODULES["scandir"] = None
+        results.append(sorted(self.scan()))
+        return results
+
+    def test_symlink_loop(self):
+        write_file(os.path.join(self.source, "a.txt"), "A\n")
+        write_file(os.path.join(self.source, "sub", "b.txt"), "B\n")
+        os.symlink("..", os.path.join(self.source, "sub", "up"))
+        os.symlink("..", os.path.join(self.source, "sub", "up2"))
+        expected = [os.path.join(self.source, "a.txt"), os.path.join(self.source, "sub", "b.txt")]
+        for found in self.scan_both():
+            self.assertEqual(found, expected)
+
+    def test_file_symlink(self):
+        write_file(os.path.join(self.source, "a.txt"), "A\n")
+        os.symlink("a.txt", os.path.join(self.source, "b.txt"))
+        expected = [os.path.join(self.source, "a.txt"), os.path.join(self.source, "b.txt")]
+        for found in self.scan_both():
+            self.assertEqual(found, expected)
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        write_file(os.path.join(self.source, "a.txt"), "Old title\n\nA\n")
+        write_file(os.path.join(self.source, "b.txt"), "Middle\n\nB\n")
+        self.api = kiwi.Kiwi()
+        self.api.prepare_server(kiwi.parse_arguments(["serve", self.source, "--sortbytitle"]))
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+
+    def edit(self, name, text):
+        """
+        Rewrites the source file, making sure that its modification time
+        changes even on file systems with a coarse resolution.
+        """
+        filename = os.path.join(self.source, name)
+        info = os.stat(filename)
+        write_file(filename, text)
+        os.utime(filename, (info.st_atime, info.st_mtime + 10))
+
+    def test_index_title(self):
+        self.assertTrue("Old title" in self.api.render_index())
+        self.edit("a.txt", "New title\n\nA\n")
+        index = self.api.render_index()
+        self.assertTrue("New title" in index)
+        self.assertFalse("Old title" in index)
+
+    def test_navigation_order(self):
+        self.assertEqual([page.name for page in self.api.pages.files], ["b.txt", "a.txt"])
+        self.api.render_link("b.html")
+        self.edit("a.txt", "Another title\n\nA\n")
+        self.api.render_index()
+        self.assertEqual([page.name for page in self.api.pages.files], ["a.txt", "b.txt"])
+        self.assertEqual(len(self.api.cache.entries), 0)
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.target)
+
+    def test_rebuild_date(self):
+        source_file = os.path.join(self.source, "a.txt")
+        write_file(source_file, "Title\n\n@@DATE:\"%Y-%m-%d\"\n")
+        api = kiwi.Kiwi()
+        api.execute(kiwi.parse_arguments([self.source, "-t", self.target]))
+        # As if the first build had been on an earlier day
+        api.build_time = datetime.datetime(2000, 1, 1)
+        api.dates = {"%Y-%m-%d": "2000-01-01"}
+        write_file(source_file, "Title\n\nChanged on @@DATE:\"%Y-%m-%d\"\n")
+        api.rebuild(set([source_file]), set())
+        f = open(os.path.join(self.target, "a.html"))
+        output = f.read()
+        f.close()
+        self.assertTrue("Changed on " + datetime.date.today().isoformat() in output)
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        for idx in range(20):
+            write_file(os.path.join(self.source, "page%02d.txt" % idx), "Page %d\n\nText\n" % idx)
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.target)
+        del kiwi.open
+
+    def test_reader_thread(self):
+        # Record which thread opens each source file
+        opened = {}
+        def recording_open(filename, *args):
+            if filename.startswith(self.source + os.sep):
+                thread = threading.current_thread().name
+                opened.setdefault(thread, []).append(filename)
+            return open(filename, *args)
+        kiwi.open = recording_open
+        api = kiwi.Kiwi()
+        api.execute(kiwi.parse_arguments([self.source, "-t", self.target, "--pipeline"]))
+        sources = sorted(os.path.join(self.source, "page%02d.txt" % idx) for idx in range(20))
+        main = threading.current_thread().name
+        # The main thread only reads as far as the titles, and the rest of
+        # the reading is left to the reader thread
+        self.assertEqual(sorted(opened.pop(main)), sources)
+        self.assertEqual([sorted(names) for names in opened.values()], [sources])
+        self.assertEqual(sorted(os.listdir(self.target)), sorted("page%02d.html" % idx for idx in range(20)))
+
+class TestCompress(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        for idx in range(20):
+            write_file(os.path.join(self.source, "page%02d.txt" % idx), "Page %d\n\nText\n" % idx)
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.target)
+
+    def test_compressed_copies(self):
+        api = kiwi.Kiwi()
+        api.execute(kiwi.parse_arguments([self.source, "-t", self.target, "-c", "-z"]))
+        self.assertEqual(api.compressor, None)
+        names = ["index.html"] + ["page%02d.html" % idx for idx in range(20)]
+        for name in names:
+            filename = os.path.join(self.target, name)
+            f = open(filename)
+            output = f.read()
+            f.close()
+            f = gzip.open(filename + ".gz")
+            self.assertEqual(f.read(), output)
+            f.close()
+
+class TestMarkupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = kiwi.KiwiMarkupCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_only_hit(self):
+        key = self.cache.key(["Title\n", "\n", "Text\n"])
+        self.cache.put(key, ["<p>Text</p>", ""])
+        def failing_utime(filename, times):
+            raise OSError(1, "Operation not permitted", filename)
+        utime = os.utime
+        os.utime = failing_utime
+        try:
+            lines = self.cache.get(key)
+        finally:
+            os.utime = utime
+        self.assertEqual(lines, ["<p>Text</p>", ""])
+        self.assertEqual(self.cache.counts()[:2], (1, 0))
+
+class TestMinifier(unittest.TestCase):
+
+    def minify(self, lines):
+        return list(kiwi.KiwiMinifier().minify(lines))
+
+    def test_comment_gap(self):
+        self.assertEqual(self.minify(["<body>", "    </div> <!-- Page -->", "</body>"]),
+                         ["<body></div></body>"])
+        self.assertEqual(self.minify(["<div> <!-- a --> <p>x <!-- b --> y</p></div>"]),
+                         ["<div><p>x y</p></div>"])
+
+    def test_code(self):
+        self.assertEqual(self.minify(["<p>Use <code>a  <b> </b>  b</code> here</p>"]),
+                         ["<p>Use <code>a  <b> </b>  b</code> here</p>"])
+        self.assertEqual(self.minify(["<div>", "<code>", "  x  <!-- y -->", "</code>", "</div>"]),
+                         ["<div><code>", "  x  <!-- y -->", "</code></div>"])
+        self.assertEqual(self.minify(["<pre><code>", "  x", "</code></pre>"]),
+                         ["<pre><code>", "  x", "</code></pre>"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Kiwi Markup Tests
+
+Differential tests for KiwiLineScanner, which only runs the line-type checks
+that can apply to each line (see KiwiLineScanner.scan). The results are
+compared with ReferenceLineScanner, which runs every check for every line,
+as the scanner did before the checks were dispatched on the leading
+characters, over a seeded corpus of randomly generated lines and documents.
+
+The inline markup, which is only applied by the substitutions that can match
+each line (see KiwiMarkup.applyInlinePatterns), is compared in the same way
+with ReferenceMarkup, which runs every substitution on every line.
+
+Run with:
+
+    python test_kiwimark.py
+"""
+
+# Standard library imports
+import re
+import random
+import unittest
+
+# Application specific imports
+import kiwimark
+
+# Number of (line, next line, state) triples, of documents and of lines of
+# inline markup to compare
+LINE_COUNT = 100000
+DOCUMENT_COUNT = 2000
+INLINE_COUNT = 100000
+
+SEED = 1
+
+# The pieces that the random lines are built from, chosen to produce every
+# type of line, and lines which nearly match them
+FRAGMENTS = ["", " ", "  ", "   ", "    ", "\t", "#", "##", "######", "*", "**",
+    "-", "--", "-----", "------", "=", "======", "|", "||", "| --- |", "|---|",
+    "* item", "  * item", "    * item", "- item", "  - item", ":", ":code",
+    "code:", "code:python", "c", "text", "word", "_emph_",
+    "**bold**", "[a](b.html)", "1.", "+", "@@TAG", "<b>", "&"]
+
+# The pieces that the random lines of inline markup are built from, chosen to
+# produce every kind of inline markup, and text which nearly matches it
+INLINE_FRAGMENTS = ["", " ", "  ", "word", "text", ".", ",", ":", ";", "?", ")",
+    "(", "\"", "*", "**", "_", "__", "**bold**", "_emph_", "**_both_**",
+    "_**both**_", " _", "_ ", "<b>", "</b>", "[", "]", "[]", "](", "(b.html)",
+    "[a](b.html)", "![alt](c.png)", "![", "[img](c.png)", "[img.right](c.png)",
+    "[img:Title](c.png)", "[img.left:Title](c.png)", "[img", "[audio](d.mp3)",
+    "[audio.player](d.mp3)", "[audio:Song](d.mp3)", "[link](e.html)",
+    "[link.ext:Site](e.html)", "[link:Site](e.html)", "[link", "[[f.html][Page]]",
+    "[[", "]]", "][", "[^1]", "[^7]", "[^12]:", "[^3]:", "[^", "[^x]"]
+
+# The details that the scanner records about each line
+ATTRIBUTES = ("isParagraph", "isHeader", "isList", "isTable", "isTableHeader",
+    "isBlock", "isBlankLine", "isHorizontalLine", "isCodeStart", "isCodeEnd",
+    "skipNextLine", "headerLevel", "headerText", "listIndent", "listText",
+    "isNestedList", "codeLanguage")
+
+class ReferenceLineScanner(kiwimark.KiwiLineScanner):
+    """
+    The line scanner as it was before the checks were dispatched on the
+    leading characters of the line, kept as the reference for the tests.
+    """
+    def scan(self, thisLine, nextLine, state):
+        self.state = state
+        self.reset()
+        if thisLine.strip() == "":
+            self.isBlankLine = True
+            self.isParagraph = False
+        else:
+            if (self.mode == kiwimark.KIWI_MODE_ORG) and (thisLine.strip()[0] == "*"):
+                match = re.search(self.orgHeaderPattern, thisLine)
+                if match:
+                    elements = match.groups()
+                    header = elements[0]
+                    level = len(header)
+                    text = ""
+                    if (len(elements) > 1):
+                        text = elements[1].strip()
+                        # Reconstruct the line as a list
+                        thisLine = "%s* %s" % (" " * level, text)
+
+            self.check_for_header(thisLine, nextLine)
+            self.check_for_table(thisLine, nextLine)
+            self.check_for_block(thisLine)
+            self.check_for_list(thisLine, nextLine)
+            self.check_for_horizontal_line(thisLine)
+            self.check_for_code_start(thisLine)
+            self.check_for_code_end(thisLine)
+
+    def check_for_header(self, thisLine, nextLine):
+        # Check for '#' style of header
+        match = re.search(self.headerPattern, thisLine)
+        if match:
+            self.isParagraph = False
+            self.isHeader = True
+            elements = match.groups()
+            header = elements[0]
+            self.headerLevel = len(header)
+            if (len(elements) > 1):
+                self.headerText = elements[1]
+        # Check for 'underline' style of header
+        elif re.search(r"^={5,}=+$", nextLine):
+            self.isParagraph = False
+            self.isHeader = True
+            self.skipNextLine = True
+            self.headerLevel = 1
+            self.headerText = thisLine
+        elif re.search(r"^-{5,}-+$", nextLine):
+            self.isParagraph = False
+            self.isHeader = True
+            self.skipNextLine = True
+            self.headerLevel = 2
+            self.headerText = thisLine
+
+    def check_for_table(self, thisLine, nextLine):
+        match = re.search(self.tableHeaderPattern, nextLine)
+        if match:
+            self.isTable = True
+            self.isTableHeader = True
+            self.skipNextLine = True
+
+        self.tableColumns = [column.strip() for column in thisLine.split("|")]
+        if (len(self.tableColumns) >= 3) or (len(self.tableColumns) > 0 and self.state.inTable):
+            self.isTable = True
+
+    def check_for_horizontal_line(self, thisLine):
+        if re.search(r"^[-]{5}[-]+$", thisLine):
+            self.isParagraph = False
+            self.isHorizontalLine = True
+
+class ReferenceMarkup(kiwimark.KiwiMarkup):
+    """
+    The inline markup as it was before the substitutions which cannot match
+    were skipped, kept as the reference for the tests. Every substitution is
+    run on every line, and the lines are not cached.
+    """
+    def re_sub(self, pattern, replacement, string):
+        """
+        Work-around for re.sub unmatched group error.
+
+        See https://gist.github.com/gromgull/3922244
+        """
+        def _r(m):
+            # The match object is replaced with a wrapper that returns ""
+            # instead of None for unmatched groups
+            class _m():
+                def __init__(self, m):
+                    self.m=m
+                    self.string=m.string
+                def group(self, n):
+                    return m.group(n) or ""
+
+            return re._expand(pattern, _m(m), replacement)
+
+        return re.sub(pattern, _r, string)
+
+    def applyInlineMarkup(self, line):
+        line = self.boldStartPattern.sub(r"\1<b>\3", line)
+        line = self.boldEndPattern.sub(r"\1</b>\3", line)
+        line = self.emphStartPattern.sub(r"\1<i>\3", line)
+        line = self.emphEndPattern.sub(r"\1</i>\3", line)
+        line = self.mdImgPattern.sub(r"<img src='\2' alt='\1' title='\1'/>", line)
+        line = self.re_sub(self.imgPattern, r"<img src='\7' class='\3' alt='\6' title='\6'/>", line)
+        line = self.re_sub(self.audioPattern, r"<audio width='300px' height='32px' src='\7' class='\3' controls='controls'> Your browser does not support audio playback. </audio>", line)
+        line = self.re_sub(self.linkPattern, r"<a href='\7' class='\3' alt='\6'>\6</a>", line)
+        line = self.mdUrlPattern.sub(r"<a href='\2'>\1</a>", line)
+        line = self.orgmodeUrlPattern.sub(r"<a href='\1'>\2</a>", line)
+        line = self.footnoteTargetPattern.sub(r"\1. <a name='footnote_target_\1' href='#footnote_ref_\1'>&#160;&#8617;</a>", line)
+        line = self.footnotePattern.sub(r"<a name='footnote_ref_\1' href='#footnote_target_\1'>[<sup>\1</sup>]</a>", line)
+        return line
+
+class LineCorpus():
+    """
+    Generates random lines and documents. The same seed always produces the
+    same corpus.
+    """
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+
+    def line(self):
+        count = self.random.randint(0, 5)
+        separator = self.random.choice(("", " "))
+        return separator.join(self.random.choice(FRAGMENTS) for i in range(count))
+
+    def inline(self):
+        count = self.random.randint(0, 6)
+        separator = self.random.choice(("", " "))
+        return separator.join(self.random.choice(INLINE_FRAGMENTS) for i in range(count))
+
+    def state(self):
+        state = kiwimark.KiwiState()
+        state.inTable = self.random.random() < 0.3
+        state.inBlock = self.random.random() < 0.3
+        return state
+
+    def document(self):
+        lines = [self.line() for i in range(self.random.randint(1, 40))]
+        if self.random.random() < 0.1:
+            lines.insert(0, "-*- mode: org -*-")
+        return lines
+
+def scanner_details(scanner):
+    """
+    Returns the details recorded by the scanner for the last line. The table
+    columns are only included for table lines, as they are not used for
+    any other lines.
+    """
+    details = [getattr(scanner, name) for name in ATTRIBUTES]
+    if scanner.isTable:
+        details.append(scanner.tableColumns)
+    return details
+
+class TestLineScanner(unittest.TestCase):
+
+    def test_scan(self):
+        corpus = LineCorpus(SEED)
+        for mode in (kiwimark.KIWI_MODE_STD, kiwimark.KIWI_MODE_ORG):
+            scanner = kiwimark.KiwiLineScanner(mode)
+            reference = ReferenceLineScanner(mode)
+            for i in range(LINE_COUNT // 2):
+                thisLine, nextLine, state = corpus.line(), corpus.line(), corpus.state()
+                scanner.scan(thisLine, nextLine, state)
+                reference.scan(thisLine, nextLine, state)
+                self.assertEqual(scanner_details(scanner), scanner_details(reference),
+                    "%r, %r (mode %d, inTable %s, inBlock %s)" % (thisLine, nextLine, mode, state.inTable, state.inBlock))
+
+    def test_documents(self):
+        corpus = LineCorpus(SEED)
+        marker = kiwimark.KiwiMarkup()
+        reference = kiwimark.KiwiMarkup()
+        reference.line = ReferenceLineScanner(kiwimark.KIWI_MODE_STD)
+        for i in range(DOCUMENT_COUNT):
+            lines = corpus.document()
+            marker.execute(lines)
+            reference.execute(lines)
+            self.assertEqual(marker.output, reference.output, "\n".join(lines))
+
+class TestInlineMarkup(unittest.TestCase):
+
+    def test_inline(self):
+        corpus = LineCorpus(SEED)
+        marker = kiwimark.KiwiMarkup()
+        reference = ReferenceMarkup()
+        for i in range(INLINE_COUNT):
+            line = corpus.inline()
+            self.assertEqual(marker.applyInlineMarkup(line), reference.applyInlineMarkup(line), repr(line))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,5 +11,8 @@ setup(name='Kiwi',
       author_email='chris@the-study.net',
       license='MIT',
       packages=['kiwi'],
+      entry_points={
+          'console_scripts': ['kiwi = kiwi.kiwi:main']
+      },
       zip_safe=False)
 